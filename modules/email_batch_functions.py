@@ -0,0 +1,265 @@
+import argparse
+import collections
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+import email_unpack_functions as unpack_fun
+import email_text_extract_functions as extract_fun
+import email_cache_functions as cache_fun
+import email_store_functions as store_fun
+import email_manifest_functions as manifest_fun
+import email_writer_functions as writer_fun
+
+# Cache connections, attachment stores and manifests opened by this worker process
+worker_caches = {}
+worker_stores = {}
+worker_manifests = {}
+
+##########################
+### Per-message worker ###
+##########################
+
+def process_eml(eml_file, output_path, cache_path=None, in_memory=False, attachment_timeout=None, message_timeout=None, store_path=None, manifest_path=None, streaming=False):
+    """
+    Description:
+        Unpacks a single eml-file and extracts the texts of its attachments. Any
+        exception is caught and returned, such that one bad e-mail does not stop a batch.
+    Parameters:
+        eml_file (str): Full path to eml-file
+        output_path (str): Output path for attachments
+        cache_path (str): Optional path to a text cache shared by the workers
+        in_memory (bool): Whether to extract attachments in memory without writing them to the output path
+        attachment_timeout (float): Maximum seconds spent on a single attachment
+        message_timeout (float): Maximum seconds spent on all attachments of the message
+        store_path (str): Optional directory of a content-addressed attachment store used instead of the output path
+        manifest_path (str): Optional path to a manifest, in which case unchanged e-mails are not processed again
+        streaming (bool): Whether to decode attachments in chunks, such that memory use does not grow with their size
+    Returns:
+        eml_file (str): Full path to eml-file
+        unpack_dic (dic): Dictionary output by unpack_attachments() or None on failure
+        error (str): Traceback of the failure or None on success
+    """
+    try:
+        cache = None
+        if cache_path:
+            if cache_path not in worker_caches:
+                worker_caches[cache_path] = cache_fun.open_cache(cache_path)
+            cache = worker_caches[cache_path]
+        store = None
+        if store_path:
+            if store_path not in worker_stores:
+                worker_stores[store_path] = store_fun.open_store(store_path)
+            store = worker_stores[store_path]
+        if manifest_path:
+            if manifest_path not in worker_manifests:
+                worker_manifests[manifest_path] = manifest_fun.open_manifest(manifest_path)
+            settings = {"attachment_timeout": attachment_timeout, "message_timeout": message_timeout, "streaming": streaming}
+            unpack_dic, stages = manifest_fun.process_eml_incremental(eml_file, output_path, worker_manifests[manifest_path], settings, cache, store)
+            unpack_dic["processed_stages"] = stages
+            return eml_file, unpack_dic, None
+        key, fileextension = unpack_fun.get_file_name(eml_file)
+        if store is not None:
+            key = store_fun.create_message_key(eml_file)
+        unpack_dic = unpack_fun.unpack_eml(eml_file, key, output_path, in_memory, store=store, streaming=streaming)
+        unpack_dic = extract_fun.unpack_attachments(unpack_dic, cache, attachment_timeout, message_timeout)
+        if in_memory and "files" in unpack_dic:
+            # Payloads are not sent back to the parent process
+            unpack_dic["files"] = {file_name: value[:2] for file_name, value in unpack_dic["files"].items()}
+        return eml_file, unpack_dic, None
+    except Exception:
+        return eml_file, None, traceback.format_exc()
+
+#########################
+### Batch processing ###
+#########################
+
+def create_worker_pool(workers, processes):
+    """
+    Description:
+        Creates a pool of worker processes, each OCR'ing pages on its share of the CPUs instead of on
+        all of them, such that the workers together do not oversubscribe the CPUs
+    Parameters:
+        workers (int): Number of worker processes of the pool
+        processes (int): Number of worker processes sharing the CPUs
+    Returns:
+        executor (concurrent.futures.ProcessPoolExecutor): Worker pool
+    """
+    return ProcessPoolExecutor(max_workers=workers, initializer=extract_fun.set_ocr_workers, initargs=(None, processes))
+
+def batch_unpack_emls(directory, output_path, extension="eml", recursive=False, workers=None, max_pending=None, cache_path=None, in_memory=False, stats=None, attachment_timeout=None, message_timeout=None, store_path=None, manifest_path=None, streaming=False):
+    """
+    Description:
+        Unpacks all eml-files in a directory on a pool of worker processes. Results are
+        yielded as soon as each message completes, so the order is not the order of the files.
+        When a worker process dies, every message in flight on the pool fails with it, so these
+        messages are retried one at a time in a separate process, and only a message that
+        crashes on its own is reported as failed.
+    Parameters:
+        directory (str): Directory with eml-files
+        output_path (str): Output path for attachments
+        extension (str): File extension of the e-mails
+        recursive (bool): Whether to include files in subfolders
+        workers (int): Number of worker processes, defaults to the number of CPUs
+        max_pending (int): Maximum number of submitted but unfinished messages, defaults to 4 x workers
+        cache_path (str): Optional path to a text cache shared by the workers
+        in_memory (bool): Whether to extract attachments in memory without writing them to the output path
+        stats (dic): Optional dictionary that is filled with counts and throughput
+        attachment_timeout (float): Maximum seconds spent on a single attachment
+        message_timeout (float): Maximum seconds spent on all attachments of a message
+        store_path (str): Optional directory of a content-addressed attachment store used instead of the output path
+        manifest_path (str): Optional path to a manifest. E-mails that did not change since the last run
+            are skipped, so an interrupted batch resumes where it stopped when it is run again.
+        streaming (bool): Whether to decode attachments in chunks, such that memory use does not grow with their size
+    Returns:
+        eml_file (str): Full path to eml-file
+        unpack_dic (dic): Dictionary output by unpack_attachments() or None on failure
+        error (str): Traceback of the failure or None on success
+    """
+    if manifest_path:
+        # Stage results are written to the output path
+        in_memory = False
+    if not in_memory and not store_path:
+        unpack_fun.make_directory(output_path)
+    eml_files = iter(unpack_fun.list_files(directory, extension, recursive))
+    workers = workers or os.cpu_count() or 1
+    max_pending = max_pending or 4 * workers
+    if stats is None:
+        stats = {}
+    stats.update({"messages": 0, "failed": 0, "attachments": 0, "timed_out": 0, "unchanged": 0, "seconds": 0.0})
+
+    start = time.perf_counter()
+    executor = create_worker_pool(workers, workers)
+    pending = {}
+    # Messages in flight when a worker died, retried one at a time in a single-worker pool
+    isolated = collections.deque()
+    retry_executor = None
+    retry_future = None
+    try:
+        while True:
+            # Keeping a bounded number of messages in flight
+            if len(pending) < max_pending:
+                for eml_file in eml_files:
+                    pending[executor.submit(process_eml, eml_file, output_path, cache_path, in_memory, attachment_timeout, message_timeout, store_path, manifest_path, streaming)] = eml_file
+                    if len(pending) >= max_pending:
+                        break
+            if retry_future is None and isolated:
+                retry_executor = retry_executor or create_worker_pool(1, workers)
+                eml_file = isolated.popleft()
+                retry_future = retry_executor.submit(process_eml, eml_file, output_path, cache_path, in_memory, attachment_timeout, message_timeout, store_path, manifest_path, streaming)
+                pending[retry_future] = eml_file
+            if not pending:
+                break
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            broken = False
+            for future in done:
+                eml_file = pending.pop(future)
+                crashed = isinstance(future.exception(), BrokenProcessPool)
+                if future is retry_future:
+                    retry_future = None
+                    if crashed:
+                        # The message crashed its worker on its own, and the pool is replaced for the next one
+                        retry_executor.shutdown(wait=False)
+                        retry_executor = None
+                elif crashed:
+                    broken = True
+                    isolated.append(eml_file)
+                    continue
+                try:
+                    eml_file, unpack_dic, error = future.result()
+                except Exception:
+                    # The worker process died, e.g. a crash in a native library
+                    unpack_dic, error = None, traceback.format_exc()
+                stats["messages"] += 1
+                if error:
+                    stats["failed"] += 1
+                    print("WARN: Something went wrong when unpacking: " + eml_file)
+                elif "files" in unpack_dic:
+                    stats["attachments"] += len(unpack_dic["files"])
+                    stats["timed_out"] += len(unpack_dic.get("timed_out", []))
+                if unpack_dic is not None and unpack_dic.get("processed_stages") == []:
+                    stats["unchanged"] += 1
+                yield eml_file, unpack_dic, error
+
+            # A dead worker breaks the whole pool, so the pool is replaced and its messages are isolated
+            if broken:
+                executor.shutdown(wait=False, cancel_futures=True)
+                executor = create_worker_pool(workers, workers)
+                for future, eml_file in list(pending.items()):
+                    if future is not retry_future:
+                        del pending[future]
+                        isolated.append(eml_file)
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+        if retry_executor is not None:
+            retry_executor.shutdown(wait=True, cancel_futures=True)
+
+    stats["seconds"] = time.perf_counter() - start
+    stats.update(compute_throughput(stats))
+
+def compute_throughput(stats):
+    """
+    Description:
+        Computes messages and attachments per second for a finished batch
+    Parameters:
+        stats (dic): Dictionary filled by batch_unpack_emls()
+    Returns:
+        throughput (dic): Messages and attachments per second
+    """
+    seconds = stats["seconds"] or float("nan")
+    return {"messages_per_second": stats["messages"] / seconds, "attachments_per_second": stats["attachments"] / seconds}
+
+def report_throughput(stats):
+    """
+    Description:
+        Prints a summary of a finished batch
+    Parameters:
+        stats (dic): Dictionary filled by batch_unpack_emls()
+    """
+    print("INFO: Processed {messages} messages ({failed} failed, {unchanged} unchanged) and {attachments} attachments ({timed_out} timed out) in {seconds:.1f} s".format(**stats))
+    print("INFO: Throughput {messages_per_second:.2f} messages/s, {attachments_per_second:.2f} attachments/s".format(**stats))
+
+##############################
+### Command-line interface ###
+##############################
+
+def main(argv=None):
+    """
+    Description:
+        Command-line entry point, e.g. python email_batch_functions.py /mnt/emls /mnt/attachments --workers 8
+    Parameters:
+        argv (list): Command-line arguments, defaults to sys.argv
+    """
+    parser = argparse.ArgumentParser(description="Unpacks a directory of eml-files in parallel")
+    parser.add_argument("directory", help="Directory with eml-files")
+    parser.add_argument("output_path", help="Output path for attachments")
+    parser.add_argument("--extension", default="eml", help="File extension of the e-mails")
+    parser.add_argument("--recursive", action="store_true", help="Include files in subfolders")
+    parser.add_argument("--workers", type=int, default=None, help="Number of worker processes")
+    parser.add_argument("--cache", default=None, help="Path to a SQLite cache of extracted texts")
+    parser.add_argument("--in-memory", action="store_true", help="Extract attachments in memory without writing them to output_path")
+    parser.add_argument("--attachment-timeout", type=float, default=None, help="Maximum seconds spent on a single attachment")
+    parser.add_argument("--message-timeout", type=float, default=None, help="Maximum seconds spent on all attachments of a message")
+    parser.add_argument("--store", default=None, help="Directory of a content-addressed attachment store, used instead of output_path")
+    parser.add_argument("--manifest", default=None, help="Path to a SQLite manifest, e-mails that did not change since the last run are skipped")
+    parser.add_argument("--streaming", action="store_true", help="Decode attachments in chunks instead of parsing whole messages into memory")
+    parser.add_argument("--results", default=None, help="Directory to stream the results to as sharded files")
+    parser.add_argument("--format", default="jsonl", choices=["jsonl", "parquet"], help="Format of the result shards")
+    parser.add_argument("--drop-fields", nargs="*", default=[], help="Fields not written to the result shards, e.g. html html_text")
+    args = parser.parse_args(argv)
+
+    writer = writer_fun.open_writer(args.results, args.format, args.drop_fields) if args.results else None
+    stats = {}
+    for eml_file, unpack_dic, error in batch_unpack_emls(args.directory, args.output_path, args.extension, args.recursive, args.workers, cache_path=args.cache, in_memory=args.in_memory, stats=stats, attachment_timeout=args.attachment_timeout, message_timeout=args.message_timeout, store_path=args.store, manifest_path=args.manifest, streaming=args.streaming):
+        if error:
+            print(error)
+        elif writer is not None:
+            writer_fun.append_result(writer, unpack_dic)
+    if writer is not None:
+        writer_fun.close_writer(writer)
+    report_throughput(stats)
+
+if __name__ == "__main__":
+    main()
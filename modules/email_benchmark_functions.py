@@ -0,0 +1,832 @@
+import argparse
+import itertools
+import json
+import os
+import random
+import resource
+import struct
+import subprocess
+import sys
+import time
+import zlib
+import numpy as np
+from email import message_from_file
+from email.mime.application import MIMEApplication
+from email.mime.base import MIMEBase
+from email.mime.image import MIMEImage
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from email.header import Header
+from email import encoders as email_encoders
+import email_unpack_functions as unpack_fun
+import email_text_extract_functions as extract_fun
+
+# Texts covering the patterns of the cleaning functions
+CLEANING_SAMPLE_TEXTS = [
+    "Mødet er d. 12. januar 2020 kl. 14:30 og varer til 15:45:10.5 ",
+    "Beløb: 1.234,56 kr. og -1.000,00 kr. samt -12,5 og 3,14159 \n\n\t ",
+    "CPR 010203-1234 og 0102031234 er fortrolige, ring på +45 12 34 56 78!",
+    "Dato 2020-01-20, 20/01/2020, 20.01.2020, 1/2 og 20 jan 2020 ",
+    "Special characters: \\ ` * _ { } [ ] ( ) < > # + ! $ ' ? @ æøå",
+    "Tal 42, 3.5 og 7. samt 1000 og v2.0 :  : 10: :20",
+    "",
+    "   \xa0 Tekst uden tal \r\n med whitespace\u2003og unicode ",
+    " \x1c\x85\u2028\u3000 ",
+    "\tLeading and trailing whitespace\n",
+]
+
+CLEANING_FLAGS = ["remove_extra_whitespaces_bool", "remove_characters_bool", "replace_dates_bool", "replace_times_bool", "replace_amounts_bool", "replace_cpr_bool", "replace_numbers_bool"]
+
+################################
+### Text cleaning benchmarks ###
+################################
+
+def reference_clean_text(text, remove_extra_whitespaces_bool=True, remove_characters_bool=True, replace_dates_bool=True, replace_times_bool=True, replace_amounts_bool=True, replace_cpr_bool=True, replace_numbers_bool=True):
+    """
+    Description:
+        Cleans a text by calling the individual cleaning functions one after another,
+        which is how collect_and_clean_text() cleaned texts before the compiled rules
+    Parameters:
+        text (str): Text
+        The flags of collect_and_clean_text()
+    Returns:
+        text (str): Clean text
+    """
+    if remove_extra_whitespaces_bool:
+        text = extract_fun.remove_extra_whitespaces(text)
+    if replace_dates_bool:
+        text = extract_fun.replace_dates(text)
+    if replace_times_bool:
+        text = extract_fun.replace_times(text)
+    if replace_amounts_bool:
+        text = extract_fun.replace_amounts(text)
+    if replace_cpr_bool:
+        text = extract_fun.replace_cpr(text)
+    if remove_characters_bool:
+        text = extract_fun.remove_characters(text)
+    if replace_numbers_bool:
+        text = extract_fun.replace_numbers(text)
+    if remove_extra_whitespaces_bool:
+        text = extract_fun.remove_extra_whitespaces(text)
+    return text
+
+def check_cleaning_equivalence(texts=CLEANING_SAMPLE_TEXTS):
+    """
+    Description:
+        Checks that the compiled cleaning rules give the same output as the individual
+        cleaning functions for every combination of flags
+    Parameters:
+        texts (list): Texts to compare on
+    Returns:
+        comparisons (int): Number of texts x flag combinations compared
+    """
+    comparisons = 0
+    for values in itertools.product([True, False], repeat=len(CLEANING_FLAGS)):
+        flags = dict(zip(CLEANING_FLAGS, values))
+        rules = extract_fun.compile_cleaning_rules(**flags)
+        for text in texts:
+            expected = reference_clean_text(text, **flags)
+            actual = extract_fun.clean_text(text, rules)
+            if actual != expected:
+                raise AssertionError("Cleaning differs for flags %s on text %r: %r != %r" % (flags, text[:100], actual[:100], expected[:100]))
+            comparisons += 1
+    return comparisons
+
+def time_function(function, repeat=5):
+    """
+    Description:
+        Times a function without arguments
+    Parameters:
+        function (function): Function to time
+        repeat (int): Number of runs
+    Returns:
+        seconds (float): Fastest run in seconds
+    """
+    timings = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+def benchmark_cleaning(texts=CLEANING_SAMPLE_TEXTS, scale=1000, repeat=5):
+    """
+    Description:
+        Compares the speed of the individual cleaning functions with the compiled cleaning rules
+    Parameters:
+        texts (list): Texts to clean
+        scale (int): Each text is repeated this many times to resemble long texts with attachments
+        repeat (int): Number of runs, the fastest is reported
+    Returns:
+        result (dic): Seconds for each implementation and the speedup
+    """
+    long_texts = [text * scale for text in texts]
+    rules = extract_fun.compile_cleaning_rules()
+    reference = time_function(lambda: [reference_clean_text(text) for text in long_texts], repeat)
+    compiled = time_function(lambda: [extract_fun.clean_text(text, rules) for text in long_texts], repeat)
+    characters = sum(len(text) for text in long_texts)
+    return {"characters": characters, "reference_seconds": reference, "compiled_seconds": compiled, "speedup": reference / compiled}
+
+############################
+### HTML text benchmarks ###
+############################
+
+def collect_html_bodies(directory, extension="eml", recursive=True):
+    """
+    Description:
+        Collects the decoded text/html parts of all e-mails in a directory
+    Parameters:
+        directory (str): Directory with eml-files
+        extension (str): File extension of the e-mails
+        recursive (bool): Whether to include files in subfolders
+    Returns:
+        html_bodies (list): HTML of every text/html part
+    """
+    html_bodies = []
+    for eml_file in unpack_fun.list_files(directory, extension, recursive):
+        with open(eml_file) as eml_file_io:
+            message = message_from_file(eml_file_io)
+        for part in message.walk():
+            if part.get_content_type() == "text/html" and not part.get_filename():
+                html_bodies.append(unpack_fun.decode_text_and_html_payload(part))
+    return html_bodies
+
+def compare_html_engines(html_bodies):
+    """
+    Description:
+        Compares html_to_text() with BeautifulSoup's get_text() on a corpus of HTML
+    Parameters:
+        html_bodies (list): HTML documents
+    Returns:
+        mismatches (list): Indices of the documents where the two engines differ
+    """
+    from bs4 import BeautifulSoup
+    mismatches = []
+    for i, html in enumerate(html_bodies):
+        expected = BeautifulSoup(html, features="lxml").get_text(separator=' ')
+        if unpack_fun.html_to_text(html) != expected:
+            mismatches.append(i)
+    return mismatches
+
+def benchmark_html_engines(html_bodies, repeat=5):
+    """
+    Description:
+        Compares the speed of BeautifulSoup and html_to_text() on a corpus of HTML
+    Parameters:
+        html_bodies (list): HTML documents
+        repeat (int): Number of runs, the fastest is reported
+    Returns:
+        result (dic): Seconds for each engine and the speedup
+    """
+    from bs4 import BeautifulSoup
+    bs4 = time_function(lambda: [BeautifulSoup(html, features="lxml").get_text(separator=' ') for html in html_bodies], repeat)
+    lxml = time_function(lambda: [unpack_fun.html_to_text(html) for html in html_bodies], repeat)
+    characters = sum(len(html) for html in html_bodies)
+    return {"documents": len(html_bodies), "characters": characters, "bs4_seconds": bs4, "lxml_seconds": lxml, "speedup": bs4 / lxml}
+
+##################################
+### Synthetic corpus generator ###
+##################################
+
+CORPUS_KINDS = ["nested", "large_attachment", "inline_images", "huge_html", "smime", "mixed_charsets"]
+CORPUS_WORDS = ["faktura", "betaling", "kunde", "aftale", "møde", "tilbud", "kr.", "12.03.2020", "14:30", "1.234,56", "venlig", "hilsen", "øre", "Århus", "straße", "señor"]
+
+def create_png(width, height, rng):
+    """
+    Description:
+        Creates a small grayscale png with random pixels
+    Parameters:
+        width (int): Width in pixels
+        height (int): Height in pixels
+        rng (random.Random): Random generator
+    Returns:
+        png (bytes): Content of png-file
+    """
+    def chunk(kind, content):
+        return struct.pack(">I", len(content)) + kind + content + struct.pack(">I", zlib.crc32(kind + content) & 0xffffffff)
+    rows = b"".join(b"\x00" + bytes(rng.randrange(256) for x in range(width)) for y in range(height))
+    header = struct.pack(">IIBBBBB", width, height, 8, 0, 0, 0, 0)
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header) + chunk(b"IDAT", zlib.compress(rows)) + chunk(b"IEND", b"")
+
+def create_sentences(rng, words):
+    """
+    Description:
+        Creates random text from CORPUS_WORDS
+    Parameters:
+        rng (random.Random): Random generator
+        words (int): Number of words
+    Returns:
+        text (str): Random text
+    """
+    return " ".join(rng.choice(CORPUS_WORDS) for i in range(words))
+
+def create_synthetic_message(kind, number, rng, attachment_bytes=5*1024**2):
+    """
+    Description:
+        Creates one synthetic e-mail of a given kind. Boundaries, dates and IDs are
+        derived from the message number, so the output only depends on the seed.
+    Parameters:
+        kind (str): One of CORPUS_KINDS
+        number (int): Number of message in corpus
+        rng (random.Random): Random generator
+        attachment_bytes (int): Size of the attachment of "large_attachment" messages
+    Returns:
+        message (email.message.Message): Synthetic e-mail
+    """
+    boundaries = ("=_boundary_%d_%d" % (number, i) for i in itertools.count())
+    if kind == "nested":
+        message = MIMEMultipart("mixed", boundary=next(boundaries))
+        current = message
+        for depth in range(8):
+            child = MIMEMultipart("alternative" if depth % 2 else "mixed", boundary=next(boundaries))
+            current.attach(MIMEText(create_sentences(rng, 50), "plain", "utf-8"))
+            current.attach(child)
+            current = child
+        current.attach(MIMEText(create_sentences(rng, 50), "plain", "utf-8"))
+    elif kind == "large_attachment":
+        message = MIMEMultipart("mixed", boundary=next(boundaries))
+        message.attach(MIMEText(create_sentences(rng, 100), "plain", "utf-8"))
+        message.attach(MIMEApplication(rng.randbytes(attachment_bytes), Name="data_%d.bin" % number))
+        message.get_payload(1).add_header("Content-Disposition", "attachment", filename="data_%d.bin" % number)
+    elif kind == "inline_images":
+        message = MIMEMultipart("related", boundary=next(boundaries))
+        html = "".join("<p>%s</p><img src=\"cid:image%d\">" % (create_sentences(rng, 20), i) for i in range(30))
+        message.attach(MIMEText("<html><body>" + html + "</body></html>", "html", "utf-8"))
+        for i in range(30):
+            image = MIMEImage(create_png(32, 32, rng), "png")
+            image.add_header("Content-ID", "<image%d>" % i)
+            image.add_header("Content-Disposition", "inline", filename="image%d.png" % i)
+            message.attach(image)
+    elif kind == "huge_html":
+        message = MIMEMultipart("alternative", boundary=next(boundaries))
+        rows = "".join("<tr><td class=\"c%d\">%s</td><td><a href=\"https://example.com/%d\">link</a></td></tr>\n" % (i % 7, create_sentences(rng, 10), i) for i in range(5000))
+        html = "<html><head><style>td{color:red}</style><script>var tracking=1;</script></head><body><!-- marketing --><table>" + rows + "</table></body></html>"
+        message.attach(MIMEText(create_sentences(rng, 100), "plain", "utf-8"))
+        message.attach(MIMEText(html, "html", "utf-8"))
+    elif kind == "smime":
+        inner = MIMEMultipart("mixed", boundary=next(boundaries))
+        inner.attach(MIMEText(create_sentences(rng, 200), "plain", "utf-8"))
+        # Signed data as produced by mail clients: DER framing followed by the MIME content
+        message = MIMEBase("application", "pkcs7-mime", name="smime.p7m", **{"smime-type": "signed-data"})
+        message.set_payload(b"\x30\x82\x10\x00\x06\x09*\x86H\x86\xf7\r\x01\x07\x02" + inner.as_bytes())
+        message.add_header("Content-Disposition", "attachment", filename="smime.p7m")
+        email_encoders.encode_base64(message)
+    else:
+        message = MIMEMultipart("mixed", boundary=next(boundaries))
+        for charset in ["utf-8", "iso-8859-1", "windows-1252", "iso-8859-15"]:
+            message.attach(MIMEText(create_sentences(rng, 100).replace("straße", "strasse").replace("señor", "senor"), "plain", charset))
+        message.attach(MIMEText("<p>" + create_sentences(rng, 100) + "</p>", "html", "iso-8859-1"))
+        message.attach(MIMEText(create_sentences(rng, 100), "plain", "utf-8"))
+    message["From"] = Header("Søren Ærø <soeren@example.dk>", "utf-8")
+    message["To"] = "Modtager <modtager@example.dk>"
+    message["Subject"] = Header("Synthetic %s message %d: %s" % (kind, number, create_sentences(rng, 5)), "iso-8859-1" if kind == "mixed_charsets" else "utf-8")
+    message["Date"] = "Mon, 20 Jan 2020 15:%02d:%02d +0000" % (number // 60 % 60, number % 60)
+    message["Message-ID"] = "<synthetic.%d@example.dk>" % number
+    return message
+
+def generate_synthetic_corpus(directory, messages=60, seed=0, kinds=CORPUS_KINDS, attachment_bytes=5*1024**2):
+    """
+    Description:
+        Writes a deterministic corpus of synthetic eml-files covering deep nested multipart,
+        large base64 attachments, many inline images, huge HTML bodies, S/MIME wrappers and
+        mixed charsets. The same seed always gives the same files.
+    Parameters:
+        directory (str): Directory to write eml-files to
+        messages (int): Number of messages, the kinds are used in turn
+        seed (int): Seed of the random generator
+        kinds (list): Kinds of messages to generate, see CORPUS_KINDS
+        attachment_bytes (int): Size of the attachment of "large_attachment" messages
+    Returns:
+        paths (list): Paths to the eml-files
+    """
+    unpack_fun.make_directory(directory)
+    rng = random.Random(seed)
+    paths = []
+    for number in range(messages):
+        kind = kinds[number % len(kinds)]
+        message = create_synthetic_message(kind, number, rng, attachment_bytes)
+        path = os.path.join(directory, "%05d_%s.eml" % (number, kind))
+        with open(path, "wb") as eml_file_io:
+            eml_file_io.write(message.as_bytes())
+        paths.append(path)
+    return paths
+
+###########################
+### Pipeline benchmarks ###
+###########################
+
+def percentiles(values, points=(50, 90, 99)):
+    """
+    Description:
+        Computes percentiles of a list of timings with linear interpolation
+    Parameters:
+        values (list): Timings
+        points (tuple): Percentiles to compute
+    Returns:
+        percentiles (dic): Count, total, the requested percentiles and max
+    """
+    values = sorted(values)
+    result = {"count": len(values), "total": sum(values)}
+    for point in points:
+        if not values:
+            result["p%d" % point] = None
+            continue
+        position = (len(values) - 1) * point / 100
+        lower = int(position)
+        upper = min(lower + 1, len(values) - 1)
+        result["p%d" % point] = values[lower] + (values[upper] - values[lower]) * (position - lower)
+    result["max"] = values[-1] if values else None
+    return result
+
+def peak_rss_bytes():
+    """
+    Description:
+        Returns the peak resident set size of this process and of its finished child processes
+    Returns:
+        peak_rss (dic): Peak RSS in bytes for self and children
+    """
+    scale = 1 if os.uname().sysname == "Darwin" else 1024
+    return {"self": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale, "children": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale}
+
+def benchmark_pipeline(eml_files, output_path, keys=["subject", "text", "html_text", "files_texts"], model_paths=None, extract_attachments=True):
+    """
+    Description:
+        Runs the pipeline stage by stage over a list of eml-files and times every call of
+        unpack_eml, extract_text_from_html_message, attachment_to_text, collect_and_clean_text
+        and, if model paths are given, predict_class.
+    Parameters:
+        eml_files (list): Paths to eml-files, e.g. from generate_synthetic_corpus()
+        output_path (str): Output path for attachments
+        keys (list): Keys passed to collect_and_clean_text()
+        model_paths (tuple): Optional path to a model bundle or paths to tokenizer, model and classes pickles
+        extract_attachments (bool): Whether to time attachment_to_text, which needs textract and tesseract
+    Returns:
+        result (dic): Machine-readable result with per-stage percentiles, throughput and peak RSS
+    """
+    unpack_fun.make_directory(output_path)
+    timings = {"unpack_eml": [], "extract_text_from_html_message": [], "attachment_to_text": [], "collect_and_clean_text": [], "predict_class": []}
+    if model_paths:
+        import email_classification_functions as classification_fun
+        tokenizer, model, classes = classification_fun.load_model_data(model_paths)
+
+    input_bytes = 0
+    start = time.perf_counter()
+    for eml_file in eml_files:
+        input_bytes += os.path.getsize(eml_file)
+        key, fileextension = unpack_fun.get_file_name(eml_file)
+        stage_start = time.perf_counter()
+        unpack_dic = unpack_fun.unpack_eml(eml_file, key, output_path)
+        timings["unpack_eml"].append(time.perf_counter() - stage_start)
+
+        with open(eml_file) as eml_file_io:
+            message = message_from_file(eml_file_io)
+        for part in message.walk():
+            if part.get_content_type() == "text/html" and not part.get_filename():
+                stage_start = time.perf_counter()
+                unpack_fun.extract_text_from_html_message(part)
+                timings["extract_text_from_html_message"].append(time.perf_counter() - stage_start)
+
+        if extract_attachments and "files" in unpack_dic:
+            files_texts = {}
+            for value in unpack_dic["files"].values():
+                stage_start = time.perf_counter()
+                files_texts[value[0]] = extract_fun.attachment_to_text(value[0])
+                timings["attachment_to_text"].append(time.perf_counter() - stage_start)
+            unpack_dic["files_texts"] = files_texts
+
+        stage_start = time.perf_counter()
+        filename, text = extract_fun.collect_and_clean_text(unpack_dic, keys)
+        timings["collect_and_clean_text"].append(time.perf_counter() - stage_start)
+
+        if model_paths:
+            stage_start = time.perf_counter()
+            classification_fun.predict_class(text, tokenizer, model, classes)
+            timings["predict_class"].append(time.perf_counter() - stage_start)
+    seconds = time.perf_counter() - start
+
+    stages = {}
+    for stage, values in timings.items():
+        stages[stage] = percentiles(values)
+        stages[stage]["calls_per_second"] = len(values) / stages[stage]["total"] if stages[stage]["total"] else None
+    return {"messages": len(eml_files), "input_bytes": input_bytes, "seconds": seconds, "messages_per_second": len(eml_files) / seconds if seconds else None, "megabytes_per_second": input_bytes / 1024**2 / seconds if seconds else None, "peak_rss_bytes": peak_rss_bytes(), "stages": stages}
+
+######################
+### OCR benchmarks ###
+######################
+
+def time_ocr_pages(image_paths, engine, language="dan"):
+    """
+    Description:
+        Times image_to_text() on every image with the given OCR engine
+    Parameters:
+        image_paths (list): Paths to images, one page each
+        engine (str): "textract" or "tesserocr", see email_text_extract_functions.set_ocr_engine()
+        language (str): Language used by tesseract for OCR
+    Returns:
+        timings (list): Seconds per page
+    """
+    previous_engine = extract_fun.ocr_settings["engine"]
+    extract_fun.set_ocr_engine(engine)
+    timings = []
+    try:
+        for path in image_paths:
+            start = time.perf_counter()
+            extract_fun.image_to_text(path, language)
+            timings.append(time.perf_counter() - start)
+    finally:
+        extract_fun.ocr_settings["engine"] = previous_engine
+    return timings
+
+def benchmark_ocr(image_paths, language="dan"):
+    """
+    Description:
+        Compares the per-page latency of a tesseract process per page (textract) with the
+        pool of persistent engines (tesserocr). The first page of the pool includes loading
+        the language data, so it is reported separately.
+    Parameters:
+        image_paths (list): Paths to images, one page each
+        language (str): Language used by tesseract for OCR
+    Returns:
+        result (dic): Percentiles of seconds per page for each engine
+    """
+    result = {"pages": len(image_paths), "textract": percentiles(time_ocr_pages(image_paths, "textract", language))}
+    if not extract_fun.TESSEROCR_AVAILABLE:
+        result["tesserocr"] = None
+        return result
+    extract_fun.close_ocr_engines()
+    timings = time_ocr_pages(image_paths, "tesserocr", language)
+    result["tesserocr_first_page"] = timings[0] if timings else None
+    result["tesserocr"] = percentiles(timings[1:])
+    if result["textract"]["p50"] is not None and result["tesserocr"]["p50"]:
+        result["speedup_p50"] = result["textract"]["p50"] / result["tesserocr"]["p50"]
+    return result
+
+#############################
+### Vectorizer benchmarks ###
+#############################
+
+def collect_clean_texts(directory, output_path, keys=["subject", "text", "html_text"], extension="eml", recursive=True):
+    """
+    Description:
+        Unpacks all e-mails in a directory and cleans their text like the pipeline does before classification
+    Parameters:
+        directory (str): Directory with eml-files
+        output_path (str): Output path for attachments
+        keys (list): Keys passed to collect_and_clean_text()
+        extension (str): File extension of the e-mails
+        recursive (bool): Whether to include files in subfolders
+    Returns:
+        texts (list): Cleaned text of every e-mail
+    """
+    unpack_fun.make_directory(output_path)
+    texts = []
+    for eml_file in unpack_fun.list_files(directory, extension, recursive):
+        key, fileextension = unpack_fun.get_file_name(eml_file)
+        unpack_dic = unpack_fun.unpack_eml(eml_file, key, output_path, in_memory=True)
+        filename, text = extract_fun.collect_and_clean_text(unpack_dic, keys)
+        texts.append(text)
+    return texts
+
+def check_compiled_tokenizer(tokenizer, texts, chunk_size=1000):
+    """
+    Description:
+        Checks that a compiled vectorizer gives exactly the same sparse matrix as the pickled
+        CountVectorizer, including dtype, shape, indices and counts
+    Parameters:
+        tokenizer (sklearn.feature_extraction.text.CountVectorizer): Tokenizer loaded with import_model_data()
+        texts (list): Texts to compare on
+        chunk_size (int): Number of texts vectorized at a time
+    Returns:
+        comparisons (int): Number of texts compared
+    """
+    import email_classification_functions as classification_fun
+    compiled = classification_fun.compile_tokenizer(tokenizer)
+    for start in range(0, len(texts), chunk_size):
+        chunk = texts[start:start+chunk_size]
+        expected = tokenizer.transform(chunk)
+        actual = classification_fun.vectorize_texts(chunk, compiled)
+        expected.sort_indices()
+        if actual.dtype != expected.dtype or actual.shape != expected.shape:
+            raise AssertionError("Vectorization differs in dtype or shape: %s %s != %s %s" % (actual.dtype, actual.shape, expected.dtype, expected.shape))
+        if not (np.array_equal(actual.indptr, expected.indptr) and np.array_equal(actual.indices, expected.indices) and np.array_equal(actual.data, expected.data)):
+            rows = np.flatnonzero(np.asarray((actual != expected).sum(axis=1)).reshape(-1))
+            raise AssertionError("Vectorization differs on text %d: %r" % (start + rows[0], chunk[rows[0]][:100]))
+    return len(texts)
+
+def benchmark_tokenizer(tokenizer, texts, chunk_size=1000, repeat=5):
+    """
+    Description:
+        Compares the throughput of the pickled CountVectorizer with the compiled vectorizer,
+        both for chunks of texts as in predict_classes() and one text at a time as in predict_class()
+    Parameters:
+        tokenizer (sklearn.feature_extraction.text.CountVectorizer): Tokenizer loaded with import_model_data()
+        texts (list): Cleaned texts
+        chunk_size (int): Number of texts vectorized at a time
+        repeat (int): Number of runs, the fastest is reported
+    Returns:
+        result (dic): Seconds and texts per second for each implementation and the speedups
+    """
+    import email_classification_functions as classification_fun
+    start = time.perf_counter()
+    compiled = classification_fun.compile_tokenizer(tokenizer)
+    compile_seconds = time.perf_counter() - start
+    chunks = [texts[i:i+chunk_size] for i in range(0, len(texts), chunk_size)]
+    result = {"texts": len(texts), "characters": sum(len(text) for text in texts), "compile_seconds": compile_seconds}
+    for mode, batches in (("chunked", chunks), ("single", [[text] for text in texts])):
+        reference = time_function(lambda: [tokenizer.transform(batch) for batch in batches], repeat)
+        fast = time_function(lambda: [classification_fun.vectorize_texts(batch, compiled) for batch in batches], repeat)
+        result[mode] = {"reference_seconds": reference, "compiled_seconds": fast, "reference_texts_per_second": len(texts) / reference if reference else None,
+                        "compiled_texts_per_second": len(texts) / fast if fast else None, "speedup": reference / fast if fast else None}
+    return result
+
+# Heavy dependencies, which are imported on first use, and the maximum seconds a cold import of
+# the unpack and cleaning modules may take
+HEAVY_MODULES = ["textract", "lxml", "bs4", "sklearn", "catboost", "scipy", "pyarrow", "tesserocr", "extract_msg"]
+IMPORT_BUDGETS = {"email_unpack_functions": 0.25, "email_text_extract_functions": 0.25}
+
+# Imports a module in a fresh process and reports the time it took and the heavy modules it loaded as JSON
+IMPORT_TIME_CODE = """
+import importlib, json, sys, time
+start = time.perf_counter()
+importlib.import_module(sys.argv[1])
+seconds = time.perf_counter() - start
+heavy_modules = json.loads(sys.argv[2])
+print(json.dumps({"seconds": seconds, "heavy_modules": sorted(name for name in sys.modules if name in heavy_modules)}))
+"""
+
+# Loads a model in a fresh process and reports the time and memory it took as JSON
+MODEL_LOADING_CODE = """
+import json, sys, time
+start = time.perf_counter()
+import email_classification_functions as classification_fun
+imported = time.perf_counter()
+tokenizer, model, classes = classification_fun.load_model_data(json.loads(sys.argv[1]))
+loaded = time.perf_counter()
+classification_fun.predict_class("first text to classify", tokenizer, model, classes)
+predicted = time.perf_counter()
+memory = {}
+with open("/proc/self/smaps_rollup") as smaps_io:
+    for line in smaps_io:
+        fields = line.split()
+        if fields[0] in ("Rss:", "Pss:", "Shared_Clean:", "Shared_Dirty:", "Private_Clean:", "Private_Dirty:"):
+            memory[fields[0][:-1].lower() + "_bytes"] = int(fields[1]) * 1024
+print(json.dumps(dict(memory, import_seconds=imported - start, load_seconds=loaded - imported, first_prediction_seconds=predicted - loaded)))
+"""
+
+def run_fresh_python(code, *args):
+    """
+    Description:
+        Runs code in a fresh Python process that can import the modules, and parses the JSON it prints
+    Parameters:
+        code (str): Python code printing a JSON line
+        args (str): Arguments passed to the code in sys.argv
+    Returns:
+        result (dic): Parsed output
+    """
+    environment = dict(os.environ, PYTHONPATH=os.pathsep.join([os.path.dirname(os.path.abspath(__file__)), os.environ.get("PYTHONPATH", "")]))
+    output = subprocess.run([sys.executable, "-c", code] + list(args), env=environment, stdout=subprocess.PIPE, check=True).stdout
+    return json.loads(output)
+
+def measure_import(module, repeat=5):
+    """
+    Description:
+        Times a cold import of a module, each time in a fresh Python process
+    Parameters:
+        module (str): Name of module
+        repeat (int): Number of fresh processes, the fastest is reported
+    Returns:
+        result (dic): Seconds of the fastest import and the heavy modules it loaded
+    """
+    runs = [run_fresh_python(IMPORT_TIME_CODE, module, json.dumps(HEAVY_MODULES)) for i in range(repeat)]
+    return min(runs, key=lambda run: run["seconds"])
+
+def benchmark_imports(modules=["email_unpack_functions", "email_text_extract_functions", "email_classification_functions", "email_batch_functions", "email_service_functions", "email_scan_functions"], repeat=5):
+    """
+    Description:
+        Times a cold import of every module of the pipeline
+    Parameters:
+        modules (list): Names of modules
+        repeat (int): Number of fresh processes per module, the fastest is reported
+    Returns:
+        result (dic): Result of measure_import() for each module
+    """
+    return {module: measure_import(module, repeat) for module in modules}
+
+def check_import_budget(budgets=IMPORT_BUDGETS, repeat=5):
+    """
+    Description:
+        Checks that a cold import of the unpack and cleaning modules stays within its budget and
+        loads none of the heavy dependencies, which must only be imported by the functions using them
+    Parameters:
+        budgets (dic): Maximum seconds of a cold import for each module
+        repeat (int): Number of fresh processes per module, the fastest is compared with the budget
+    Returns:
+        result (dic): Result of measure_import() for each module
+    """
+    result = {}
+    for module, budget in budgets.items():
+        result[module] = measure_import(module, repeat)
+        if result[module]["heavy_modules"]:
+            raise AssertionError("Importing %s loads %s" % (module, ", ".join(result[module]["heavy_modules"])))
+        if result[module]["seconds"] > budget:
+            raise AssertionError("Importing %s took %.3f seconds, the budget is %.3f" % (module, result[module]["seconds"], budget))
+    return result
+
+def measure_model_loading(model_paths):
+    """
+    Description:
+        Loads a model in a fresh Python process, such that nothing is imported or cached beforehand
+    Parameters:
+        model_paths (str or tuple): Path to a model bundle or paths to tokenizer, model and classes pickles
+    Returns:
+        result (dic): Seconds to import, load and predict once, and the resident and private memory of the process
+    """
+    return run_fresh_python(MODEL_LOADING_CODE, json.dumps(model_paths))
+
+def benchmark_model_loading(model_paths_list, repeat=3):
+    """
+    Description:
+        Compares process start-up with model pickles and with a model bundle. Private memory is what
+        every extra worker costs, while the memory-mapped pages of a bundle are shared and only count
+        once however many workers use it.
+    Parameters:
+        model_paths_list (list): Model paths to compare, each a bundle path or three pickle paths
+        repeat (int): Number of fresh processes per model, the fastest is reported
+    Returns:
+        result (dic): Result of measure_model_loading() for each model
+    """
+    result = {}
+    for model_paths in model_paths_list:
+        runs = [measure_model_loading(model_paths) for i in range(repeat)]
+        name = model_paths if isinstance(model_paths, str) else " ".join(model_paths)
+        result[name] = min(runs, key=lambda run: run["load_seconds"])
+    return result
+
+###############################
+### Streaming decode checks ###
+###############################
+
+def create_encoded_bodies(rng, count=3000):
+    """
+    Description:
+        Creates base64 and quoted-printable bodies, both well-formed and malformed: truncated,
+        with CRLF line breaks, garbage, missing or stray padding, concatenated encodings,
+        escapes cut at line ends and random runs of escape characters
+    Parameters:
+        rng (random.Random): Random generator
+        count (int): Number of bodies of each encoding
+    Returns:
+        bodies (list): Tuples of content-transfer-encoding and encoded body
+    """
+    import base64
+    import quopri
+    bodies = []
+    for i in range(count):
+        body = base64.encodebytes(rng.randbytes(rng.randint(0, 300)))
+        variant = i % 8
+        if variant == 1:
+            body = body[:rng.randint(0, len(body))]
+        elif variant == 2:
+            body = body.replace(b"\n", b"\r\n")
+        elif variant == 3:
+            body = body + b"garbage!!"
+        elif variant == 4:
+            body = body.rstrip(b"=\n")
+        elif variant == 5:
+            body = body + base64.encodebytes(rng.randbytes(rng.randint(1, 5)))
+        elif variant in (6, 7):
+            for stray in range(rng.randint(1, 3)):
+                position = rng.randint(0, len(body))
+                body = body[:position] + b"=" * rng.randint(1, 2) + body[position:]
+        bodies.append(("base64", body))
+    for i in range(count):
+        body = quopri.encodestring(bytes(rng.choice(b"ab =\t\xe9\n") for j in range(rng.randint(0, 400))))
+        variant = i % 4
+        if variant == 1:
+            body = body.replace(b"\n", b"\r\n")
+        elif variant == 2:
+            body = bytes(rng.choice(b"ab=3D\n\t ") for j in range(rng.randint(0, 200)))
+        elif variant == 3:
+            body = body.replace(b"\n", b"") + b"=\n=3"
+        bodies.append(("quoted-printable", body))
+    return bodies
+
+def check_streaming_decode(bodies, chunk_sizes=(1, 2, 3, 5, 7, 64, 1024**2)):
+    """
+    Description:
+        Checks that decoding a body in chunks with LazyPart.write_payload() gives exactly the same
+        bytes as get_payload(decode=True) of the email package, for every chunk size
+    Parameters:
+        bodies (list): Tuples of content-transfer-encoding and encoded body, e.g. from create_encoded_bodies()
+        chunk_sizes (list): Number of encoded bytes read at a time
+    Returns:
+        comparisons (int): Number of bodies compared
+    """
+    import io
+    from email import message_from_bytes
+    import email_index_functions as index_fun
+    for encoding, body in bodies:
+        data = b"Content-Transfer-Encoding: " + encoding.encode("ascii") + b"\n\n" + body
+        expected = message_from_bytes(data).get_payload(decode=True)
+        part = index_fun.index_part(data, 0, len(data))
+        for chunk_size in chunk_sizes:
+            payload_io = io.BytesIO()
+            part.write_payload(payload_io, chunk_size=chunk_size)
+            if payload_io.getvalue() != expected:
+                raise AssertionError("Streaming %s decode differs with chunks of %d bytes: %r" % (encoding, chunk_size, body[:100]))
+    return len(bodies)
+
+def check_streaming_unpack(eml_files):
+    """
+    Description:
+        Checks that unpack_eml() gives the same texts and attachment payloads with and without streaming
+    Parameters:
+        eml_files (list): Full paths to eml-files
+    Returns:
+        comparisons (int): Number of messages compared
+    """
+    for eml_file in eml_files:
+        key, fileextension = unpack_fun.get_file_name(eml_file)
+        results = [unpack_fun.unpack_eml(eml_file, key, None, in_memory=True, spill_threshold=float("inf"), streaming=streaming) for streaming in (False, True)]
+        for result in results:
+            # Attachment names contain a random ID, so only content-IDs and payloads are compared
+            result["files"] = {file_name: file[1:] for file_name, file in result.get("files", {}).items()}
+        if results[0] != results[1]:
+            raise AssertionError("Streaming unpack differs on " + eml_file)
+    return len(eml_files)
+
+##############################
+### Command-line interface ###
+##############################
+
+def main(argv=None):
+    """
+    Description:
+        Command-line entry point, e.g. python email_benchmark_functions.py cleaning
+        or python email_benchmark_functions.py html --directory /mnt/emls
+        or python email_benchmark_functions.py pipeline --directory /tmp/corpus --output result.json
+        or python email_benchmark_functions.py ocr --files page1.png page2.png
+        or python email_benchmark_functions.py tokenizer --directory /mnt/emls --model tokenizer.pkl model.pkl classes.pkl
+        or python email_benchmark_functions.py models --model tokenizer.pkl model.pkl classes.pkl --bundle /models/bundle
+        or python email_benchmark_functions.py imports --budget 0.25
+        or python email_benchmark_functions.py streaming --directory /tmp/corpus
+    Parameters:
+        argv (list): Command-line arguments, defaults to sys.argv
+    """
+    parser = argparse.ArgumentParser(description="Benchmarks for emlTextExtraction")
+    parser.add_argument("benchmark", choices=["cleaning", "html", "corpus", "pipeline", "ocr", "tokenizer", "models", "imports", "streaming"], help="Benchmark to run, corpus only generates the synthetic corpus")
+    parser.add_argument("--files", nargs="*", default=[], help="Text files to use instead of the built-in samples, or images for ocr")
+    parser.add_argument("--directory", default=None, help="Directory with eml-files, for corpus and pipeline the synthetic corpus is written here if it is empty")
+    parser.add_argument("--messages", type=int, default=60, help="Number of messages in the synthetic corpus")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic corpus")
+    parser.add_argument("--model", nargs="+", default=None, metavar="PATH", help="Model bundle, or tokenizer, model and classes pickles, used to time predict_class, the tokenizer and loading")
+    parser.add_argument("--bundle", default=None, help="Model bundle compared with the pickles by the models benchmark")
+    parser.add_argument("--budget", type=float, default=None, help="Seconds allowed for a cold import of the unpack and cleaning modules")
+    parser.add_argument("--no-attachments", action="store_true", help="Do not time attachment_to_text")
+    parser.add_argument("--output", default=None, help="Write the JSON result to this file instead of stdout")
+    args = parser.parse_args(argv)
+
+    texts = [open(path, encoding="utf-8", errors="replace").read() for path in args.files] or CLEANING_SAMPLE_TEXTS
+    if args.benchmark == "cleaning":
+        result = {"comparisons": check_cleaning_equivalence(texts)}
+        result.update(benchmark_cleaning(texts, scale=1 if args.files else 1000))
+    elif args.benchmark == "html":
+        html_bodies = collect_html_bodies(args.directory) if args.directory else [open(path, encoding="utf-8", errors="replace").read() for path in args.files]
+        result = {"mismatches": compare_html_engines(html_bodies)}
+        result.update(benchmark_html_engines(html_bodies))
+    elif args.benchmark == "ocr":
+        result = benchmark_ocr(args.files)
+    elif args.benchmark == "imports":
+        budgets = {module: args.budget for module in IMPORT_BUDGETS} if args.budget else IMPORT_BUDGETS
+        result = {"budgets": budgets, "budget_checks": check_import_budget(budgets), "modules": benchmark_imports()}
+    elif args.benchmark == "models":
+        result = benchmark_model_loading([path for path in [args.model, args.bundle] if path])
+    elif args.benchmark == "tokenizer":
+        import email_classification_functions as classification_fun
+        if not args.model or len(args.model) != 3:
+            parser.error("the tokenizer benchmark requires the three pickles")
+        tokenizer, model, classes = classification_fun.import_model_data(*args.model)
+        texts = collect_clean_texts(args.directory, os.path.join(args.directory, "attachments")) if args.directory else texts
+        result = {"comparisons": check_compiled_tokenizer(tokenizer, texts)}
+        result.update(benchmark_tokenizer(tokenizer, texts))
+    else:
+        if not args.directory:
+            parser.error("the %s benchmark requires --directory" % args.benchmark)
+        eml_files = unpack_fun.list_files(args.directory, "eml") if os.path.isdir(args.directory) else []
+        if not eml_files:
+            eml_files = generate_synthetic_corpus(args.directory, args.messages, args.seed)
+        if args.benchmark == "corpus":
+            result = {"messages": len(eml_files), "directory": args.directory}
+        elif args.benchmark == "streaming":
+            result = {"decode_comparisons": check_streaming_decode(create_encoded_bodies(random.Random(args.seed))), "comparisons": check_streaming_unpack(sorted(eml_files))}
+        else:
+            result = benchmark_pipeline(sorted(eml_files), os.path.join(args.directory, "attachments"), model_paths=args.model, extract_attachments=not args.no_attachments)
+
+    if args.output:
+        with open(args.output, "w") as output_io:
+            json.dump(result, output_io, indent=2)
+    else:
+        print(json.dumps(result, indent=2))
+
+if __name__ == "__main__":
+    main()
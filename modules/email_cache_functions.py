@@ -0,0 +1,152 @@
+import hashlib
+import json
+import sqlite3
+import time
+
+#####################
+### Cache storage ###
+#####################
+
+def open_cache(path, max_bytes=None):
+    """
+    Description:
+        Opens (and creates if needed) a persistent SQLite cache for extracted texts and the
+        reports of their extraction. The cache can be shared by several processes.
+    Parameters:
+        path (str): Full path to the SQLite file
+        max_bytes (int): Maximum total size of cached texts before least recently used entries are evicted.
+            If not given the stored limit is kept, which is 1 GB for a new cache.
+    Returns:
+        cache (sqlite3.Connection): Connection to the cache
+    """
+    cache = sqlite3.connect(path, timeout=60)
+    cache.execute("PRAGMA journal_mode=WAL")
+    cache.execute("CREATE TABLE IF NOT EXISTS texts (key TEXT PRIMARY KEY, text TEXT NOT NULL, size INTEGER NOT NULL, last_used REAL NOT NULL, report TEXT)")
+    if "report" not in [column[1] for column in cache.execute("PRAGMA table_info(texts)")]:
+        # Caches created before reports were cached
+        cache.execute("ALTER TABLE texts ADD COLUMN report TEXT")
+    cache.execute("CREATE INDEX IF NOT EXISTS texts_last_used ON texts (last_used)")
+    cache.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+    cache.execute("CREATE TABLE IF NOT EXISTS settings (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+    cache.execute("INSERT OR IGNORE INTO settings VALUES ('max_bytes', ?)", (1024**3,))
+    if max_bytes is not None:
+        cache.execute("UPDATE settings SET value = ? WHERE name = 'max_bytes'", (max_bytes,))
+    cache.execute("INSERT OR IGNORE INTO settings SELECT 'total_bytes', COALESCE(SUM(size), 0) FROM texts")
+    cache.commit()
+    return cache
+
+def create_cache_key(path, settings, chunk_size=1024**2):
+    """
+    Description:
+        Creates a key from the content of a file and the settings used to extract it,
+        such that identical attachments share the key regardless of their filename.
+    Parameters:
+        path (str): Full path to file
+        settings (dic): Extraction settings, e.g. extension, encoding and OCR language
+        chunk_size (int): Number of bytes hashed at a time
+    Returns:
+        key (str): Hex digest identifying content and settings
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as file_io:
+        for chunk in iter(lambda: file_io.read(chunk_size), b""):
+            digest.update(chunk)
+    digest.update(json.dumps(settings, sort_keys=True).encode("utf-8"))
+    return digest.hexdigest()
+
+def increment_counter(cache, name):
+    """
+    Description:
+        Increments a hit/miss counter in the cache
+    Parameters:
+        cache (sqlite3.Connection): Connection to the cache
+        name (str): Name of counter
+    """
+    cache.execute("INSERT INTO counters VALUES (?, 1) ON CONFLICT(name) DO UPDATE SET value = value + 1", (name,))
+
+def cache_get(cache, key, report=None):
+    """
+    Description:
+        Looks up a text in the cache and marks it as recently used
+    Parameters:
+        cache (sqlite3.Connection): Connection to the cache
+        key (str): Key created by create_cache_key()
+        report (dic): Optional dictionary that is filled with the report cached with the text
+    Returns:
+        text (str): Cached text or None if the key is not cached
+    """
+    row = cache.execute("SELECT text, report FROM texts WHERE key = ?", (key,)).fetchone()
+    with cache:
+        if row is None:
+            increment_counter(cache, "misses")
+            return None
+        cache.execute("UPDATE texts SET last_used = ? WHERE key = ?", (time.time(), key))
+        increment_counter(cache, "hits")
+    if report is not None and row[1] is not None:
+        report.update(json.loads(row[1]))
+    return row[0]
+
+def cache_put(cache, key, text, report=None):
+    """
+    Description:
+        Stores a text in the cache and evicts the least recently used texts if the cache is full
+    Parameters:
+        cache (sqlite3.Connection): Connection to the cache
+        key (str): Key created by create_cache_key()
+        text (str): Extracted text
+        report (dic): Optional report of the extraction, e.g. pages and page decisions, stored as JSON
+    """
+    report = json.dumps(report) if report is not None else None
+    size = len(text.encode("utf-8")) + (len(report) if report is not None else 0)
+    # The write lock is taken before the old size is read, such that processes putting the same key
+    # at the same time do not both count it
+    cache.execute("BEGIN IMMEDIATE")
+    try:
+        row = cache.execute("SELECT size FROM texts WHERE key = ?", (key,)).fetchone()
+        old_size = row[0] if row else 0
+        cache.execute("INSERT OR REPLACE INTO texts VALUES (?, ?, ?, ?, ?)", (key, text, size, time.time(), report))
+        cache.execute("UPDATE settings SET value = value + ? WHERE name = 'total_bytes'", (size - old_size,))
+        evict(cache)
+        cache.execute("COMMIT")
+    except:
+        cache.execute("ROLLBACK")
+        raise
+
+def evict(cache, batch_size=100):
+    """
+    Description:
+        Deletes the least recently used texts until the cache is within its size limit
+    Parameters:
+        cache (sqlite3.Connection): Connection to the cache
+        batch_size (int): Number of candidates fetched at a time
+    """
+    settings = dict(cache.execute("SELECT name, value FROM settings").fetchall())
+    total, max_bytes = settings["total_bytes"], settings["max_bytes"]
+    evicted = 0
+    while total > max_bytes:
+        candidates = cache.execute("SELECT key, size FROM texts ORDER BY last_used LIMIT ?", (batch_size,)).fetchall()
+        if not candidates:
+            break
+        for key, size in candidates:
+            if total <= max_bytes:
+                break
+            cache.execute("DELETE FROM texts WHERE key = ?", (key,))
+            total -= size
+            evicted += 1
+    if evicted:
+        cache.execute("UPDATE settings SET value = ? WHERE name = 'total_bytes'", (total,))
+        cache.execute("INSERT INTO counters VALUES ('evictions', ?) ON CONFLICT(name) DO UPDATE SET value = value + ?", (evicted, evicted))
+
+def cache_statistics(cache):
+    """
+    Description:
+        Returns counters and size of the cache
+    Parameters:
+        cache (sqlite3.Connection): Connection to the cache
+    Returns:
+        statistics (dic): Hits, misses, evictions, number of entries and total size in bytes
+    """
+    statistics = {"hits": 0, "misses": 0, "evictions": 0}
+    statistics.update(dict(cache.execute("SELECT name, value FROM counters").fetchall()))
+    statistics["entries"], statistics["bytes"] = cache.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM texts").fetchone()
+    return statistics
@@ -1,6 +1,26 @@
+import argparse
+import hashlib
+import itertools
+import json
+import os
 import pickle
-import sklearn
-import catboost
+import re
+import shutil
+import time
+import numpy as np
+import email_instrumentation_functions as instrument_fun
+
+# Default token pattern of CountVectorizer, which tokenize_words() reproduces without a regex for most words
+DEFAULT_TOKEN_PATTERN = r"(?u)\b\w\w+\b"
+WORD_PATTERN = re.compile(r"\w\w+")
+
+# Model bundles store the vocabulary as an array of terms of this many characters at most and a
+# hash table of their positions, longer terms are kept in long_terms.json
+BUNDLE_FORMAT_VERSION = 1
+BUNDLE_FILES = ["model.cbm", "terms.npy", "term_indices.npy", "term_table.npy", "long_terms.json", "classes.npy"]
+LONG_TERM_CHARS = 64
+# Terms are looked up in the bundle in batches of this size, which bounds the arrays built for a lookup
+LOOKUP_BATCH_TERMS = 8192
 
 def import_model_data(path_tokenizer, path_model, path_classes):
     """ 
@@ -21,20 +41,525 @@ def import_model_data(path_tokenizer, path_model, path_classes):
     
     return tokenizer, model, classes
 
+def load_model_data(model_paths):
+    """ 
+    Description:
+        Loads a model bundle or the three pickle-files and compiles the tokenizer
+    Parameters:
+        model_paths (str or tuple): Path to a model bundle, or paths to tokenizer, model and classes pickles
+    Returns:
+        tokenizer (dic): Vectorizer compiled with compile_tokenizer() or loaded with load_model_bundle()
+        model (catboost.core.CatBoostClassifier): Model for predicting on tokenized texts
+        classes (numpy.ndarray): Object to map integers to classes
+    """
+    if isinstance(model_paths, str) or len(model_paths) == 1:
+        return load_model_bundle(model_paths if isinstance(model_paths, str) else model_paths[0])
+    tokenizer, model, classes = import_model_data(*model_paths)
+    return compile_tokenizer(tokenizer), model, classes
+
+###########################
+### Compiled vectorizer ###
+###########################
+
+def compile_tokenizer(tokenizer):
+    """ 
+    Description:
+        Compiles a fitted CountVectorizer into a read-only vectorizer that gives exactly the same
+        sparse matrix as tokenizer.transform(). Preprocessing, the token pattern, stop words and
+        n-grams are fused into one analyzer, the vocabulary is a plain dictionary of Python integers,
+        and the counts of a whole chunk of texts are built as one CSR-matrix. Analyzers other than
+        "word" keep the analyzer of the tokenizer and only use the faster counting.
+    Parameters:
+        tokenizer (sklearn.feature_extraction.text.CountVectorizer): Fitted tokenizer
+    Returns:
+        compiled (dic): Compiled vectorizer used by vectorize_texts()
+    """
+    if not hasattr(tokenizer, "vocabulary_"):
+        raise ValueError("The tokenizer is not fitted")
+    vocabulary = {str(term): int(index) for term, index in tokenizer.vocabulary_.items()}
+    compiled = compile_analyzer(tokenizer)
+    compiled.update({"vocabulary": vocabulary, "size": len(vocabulary)})
+    return compiled
+
+def compile_analyzer(tokenizer):
+    """ 
+    Description:
+        Compiles the analyzer and output settings of a CountVectorizer, which need not be fitted
+    Parameters:
+        tokenizer (sklearn.feature_extraction.text.CountVectorizer): Tokenizer
+    Returns:
+        compiled (dic): Analyzer and output settings of the compiled vectorizer, without vocabulary
+    """
+    compiled = {"dtype": tokenizer.dtype, "binary": tokenizer.binary, "analyze": None}
+    if tokenizer.analyzer != "word" or tokenizer.input != "content":
+        compiled["analyze"] = tokenizer.build_analyzer()
+        return compiled
+
+    # Preprocessing is only wrapped in a function when it does more than lowercasing
+    if callable(tokenizer.preprocessor) or tokenizer.strip_accents is not None:
+        compiled["preprocess"] = tokenizer.build_preprocessor()
+    else:
+        compiled["preprocess"] = str.lower if tokenizer.lowercase else None
+    if tokenizer.tokenizer is None and tokenizer.token_pattern == DEFAULT_TOKEN_PATTERN:
+        compiled["tokenize"] = tokenize_words
+    else:
+        compiled["tokenize"] = tokenizer.build_tokenizer()
+    compiled["decode"] = tokenizer.decode
+    compiled["stop_words"] = tokenizer.get_stop_words()
+    compiled["ngram_range"] = tuple(tokenizer.ngram_range)
+    return compiled
+
+def tokenize_words(text):
+    """ 
+    Description:
+        Tokenizes like the default token pattern of CountVectorizer. Whitespace never belongs to a
+        token, so the text is split on whitespace, and only pieces with other non-word characters
+        are searched with the regex.
+    Parameters:
+        text (str): Preprocessed text
+    Returns:
+        tokens (list): Words of two or more word characters in order
+    """
+    tokens = []
+    append = tokens.append
+    extend = tokens.extend
+    findall = WORD_PATTERN.findall
+    for word in text.split():
+        # str.isalnum() matches the same characters as \w apart from the underscore
+        if word.isalnum():
+            if len(word) > 1:
+                append(word)
+        else:
+            extend(findall(word))
+    return tokens
+
+def analyze_text(text, compiled):
+    """ 
+    Description:
+        Splits a text into the terms counted by a compiled vectorizer, in the same way as
+        the analyzer of the CountVectorizer it was compiled from
+    Parameters:
+        text (str): Text to analyze
+        compiled (dic): Vectorizer compiled with compile_tokenizer()
+    Returns:
+        terms (list): Terms, including n-grams
+    """
+    if not isinstance(text, str):
+        text = compiled["decode"](text)
+    if compiled["preprocess"] is not None:
+        text = compiled["preprocess"](text)
+    tokens = compiled["tokenize"](text)
+    stop_words = compiled["stop_words"]
+    if stop_words is not None:
+        tokens = [token for token in tokens if token not in stop_words]
+    min_n, max_n = compiled["ngram_range"]
+    if max_n == 1:
+        return tokens
+    terms = list(tokens) if min_n == 1 else []
+    space_join = " ".join
+    for n in range(max(min_n, 2), min(max_n, len(tokens)) + 1):
+        terms.extend(space_join(tokens[i:i+n]) for i in range(len(tokens) - n + 1))
+    return terms
+
+def hash_terms(terms):
+    """ 
+    Description:
+        Computes a 64-bit polynomial hash of every term of a numpy string array with one matrix
+        product, followed by the finalizer of MurmurHash3 to mix the low bits used as slots. Unlike
+        hash() it is the same in every process, so it can index a stored hash table, and padding
+        does not change it, so it does not depend on the width of the array.
+    Parameters:
+        terms (numpy.ndarray): Terms as a numpy string array
+    Returns:
+        hashes (numpy.ndarray): Hash of every term
+    """
+    codes = np.ascontiguousarray(terms).view(np.uint32).reshape(len(terms), -1)
+    powers = np.uint64(1099511628211) ** np.arange(codes.shape[1], dtype=np.uint64)
+    hashes = codes.astype(np.uint64) @ powers
+    hashes ^= hashes >> np.uint64(33)
+    hashes *= np.uint64(0xff51afd7ed558ccd)
+    hashes ^= hashes >> np.uint64(33)
+    return hashes
+
+def create_term_table(terms):
+    """ 
+    Description:
+        Creates an open-addressing hash table with linear probing of the positions of terms,
+        at most half full
+    Parameters:
+        terms (numpy.ndarray): Terms as a numpy string array
+    Returns:
+        table (numpy.ndarray): Position of a term in terms for every slot, -1 for empty slots
+    """
+    size = 2
+    while size < 2 * len(terms):
+        size *= 2
+    table = np.full(size, -1, dtype=np.int64)
+    for position, term_hash in enumerate(hash_terms(terms).tolist()):
+        slot = term_hash & (size - 1)
+        while table[slot] >= 0:
+            slot = (slot + 1) & (size - 1)
+        table[slot] = position
+    return table
+
+def lookup_terms(terms, compiled, batch_terms=LOOKUP_BATCH_TERMS):
+    """ 
+    Description:
+        Looks up terms in the memory-mapped vocabulary of a model bundle in batches, such that
+        the string and hash arrays of a batch stay small however many terms a chunk of texts has
+    Parameters:
+        terms (list): Terms output by the analyzer
+        compiled (dic): Vectorizer loaded with load_model_bundle()
+        batch_terms (int): Number of terms looked up at a time
+    Returns:
+        indices (numpy.ndarray): Column of every term, -1 for terms not in the vocabulary
+    """
+    indices = np.empty(len(terms), dtype=np.int64)
+    for start in range(0, len(terms), batch_terms):
+        indices[start:start+batch_terms] = lookup_term_batch(terms[start:start+batch_terms], compiled)
+    return indices
+
+def lookup_term_batch(terms, compiled):
+    """ 
+    Description:
+        Looks up a batch of terms. The terms are hashed at once and the hash table is probed
+        for all of them in parallel, so the cost per term does not depend on the size of the
+        vocabulary. Terms longer than the width of the vocabulary array are looked up in long_terms.
+    Parameters:
+        terms (list): Terms output by the analyzer
+        compiled (dic): Vectorizer loaded with load_model_bundle()
+    Returns:
+        indices (numpy.ndarray): Column of every term, -1 for terms not in the vocabulary
+    """
+    indices = np.full(len(terms), -1, dtype=np.int64)
+    if not terms:
+        return indices
+    terms_array = np.array(terms)
+    if terms_array.dtype.itemsize // 4 > compiled["width"]:
+        for position, term in enumerate(terms):
+            if len(term) > compiled["width"]:
+                indices[position] = compiled["long_terms"].get(term, -1)
+        terms_array = np.array([term if len(term) <= compiled["width"] else "" for term in terms])
+    terms = terms_array
+    table = compiled["term_table"]
+    mask = len(table) - 1
+    slots = (hash_terms(terms) & np.uint64(mask)).astype(np.int64)
+    pending = np.flatnonzero(indices < 0)
+    while len(pending):
+        positions = table[slots[pending]]
+        occupied = positions >= 0
+        found = occupied & (compiled["terms"][np.maximum(positions, 0)] == terms[pending])
+        indices[pending[found]] = compiled["term_indices"][positions[found]]
+        pending = pending[occupied & ~found]
+        slots[pending] = (slots[pending] + 1) & mask
+    return indices
+
+def vectorize_texts(texts, tokenizer):
+    """ 
+    Description:
+        Vectorizes texts with a CountVectorizer or with a vectorizer compiled by compile_tokenizer()
+        or loaded with load_model_bundle()
+    Parameters:
+        texts (list): Texts to vectorize
+        tokenizer (sklearn.feature_extraction.text.CountVectorizer or dic): Tokenizer or compiled vectorizer
+    Returns:
+        vectorized_texts (scipy.sparse.csr_matrix): Term counts of shape (texts, vocabulary)
+    """
+    if not isinstance(tokenizer, dict):
+        return tokenizer.transform(texts)
+    import scipy.sparse
+    analyze = tokenizer["analyze"]
+    terms = []
+    term_indptr = [0]
+    for text in texts:
+        terms.extend(analyze(text) if analyze is not None else analyze_text(text, tokenizer))
+        term_indptr.append(len(terms))
+    if "terms" in tokenizer:
+        indices = lookup_terms(terms, tokenizer)
+    else:
+        indices = np.fromiter(map(tokenizer["vocabulary"].get, terms, itertools.repeat(-1)), dtype=np.int64, count=len(terms))
+    found = indices >= 0
+    indptr = np.concatenate([[0], np.cumsum(found, dtype=np.int64)])[term_indptr]
+    indices = indices[found]
+    data = np.ones(len(indices), dtype=tokenizer["dtype"])
+    vectorized_texts = scipy.sparse.csr_matrix((data, indices, indptr), shape=(len(indptr) - 1, tokenizer["size"]))
+    vectorized_texts.sum_duplicates()
+    if tokenizer["binary"]:
+        vectorized_texts.data.fill(1)
+    return vectorized_texts
+
+#####################
+### Model bundles ###
+#####################
+
+def checksum_file(path, chunk_size=1024**2):
+    """ 
+    Description:
+        Computes the SHA-256 hash of a file
+    Parameters:
+        path (str): Full path to file
+        chunk_size (int): Number of bytes hashed at a time
+    Returns:
+        digest (str): Hex digest
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as file_io:
+        for chunk in iter(lambda: file_io.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def get_tokenizer_settings(tokenizer):
+    """ 
+    Description:
+        Returns the parameters of a CountVectorizer as JSON, without its vocabulary
+    Parameters:
+        tokenizer (sklearn.feature_extraction.text.CountVectorizer): Fitted tokenizer
+    Returns:
+        settings (dic): Parameters that recreate the tokenizer with CountVectorizer(**settings)
+    """
+    settings = {}
+    for name, value in tokenizer.get_params().items():
+        if name == "vocabulary":
+            continue
+        if callable(value) and name != "dtype":
+            raise ValueError("The tokenizer has a custom " + name + " and cannot be stored in a model bundle")
+        if name == "dtype":
+            value = np.dtype(value).name
+        elif isinstance(value, (tuple, set, frozenset)):
+            value = list(value) if isinstance(value, tuple) else sorted(value)
+        settings[name] = value
+    return settings
+
+def write_model_bundle(directory, tokenizer, model, classes, version=None):
+    """ 
+    Description:
+        Writes a model bundle: the model in CatBoost's native format, the vocabulary with a hash table
+        and the classes as numpy arrays that are memory-mapped when loaded, and manifest.json with the tokenizer settings
+        and the size and checksum of every file. The bundle is written under a temporary name and
+        renamed when complete.
+    Parameters:
+        directory (str): Directory of the bundle, which must not exist
+        tokenizer (sklearn.feature_extraction.text.CountVectorizer): Fitted tokenizer
+        model (catboost.core.CatBoostClassifier): Model for predicting on tokenized texts
+        classes (numpy.ndarray): Object to map integers to classes
+        version (str): Optional version of the model, e.g. a date or a training run
+    Returns:
+        manifest (dic): Content of manifest.json
+    """
+    import sklearn
+    import catboost
+    if os.path.exists(directory):
+        raise FileExistsError("Model bundle already exists: " + directory)
+    settings = get_tokenizer_settings(tokenizer)
+    vocabulary = sorted((str(term), int(index)) for term, index in tokenizer.vocabulary_.items())
+    short_terms = [(term, index) for term, index in vocabulary if len(term) <= LONG_TERM_CHARS]
+    long_terms = {term: index for term, index in vocabulary if len(term) > LONG_TERM_CHARS}
+    width = max([len(term) for term, index in short_terms] + [1])
+    terms = np.array([term for term, index in short_terms], dtype="U%d" % width)
+    classes = np.asarray(classes)
+    if classes.dtype == object:
+        classes = classes.astype(str)
+
+    temp_directory = directory.rstrip(os.sep) + ".tmp"
+    shutil.rmtree(temp_directory, ignore_errors=True)
+    os.makedirs(temp_directory)
+    try:
+        model.save_model(os.path.join(temp_directory, "model.cbm"), format="cbm")
+        np.save(os.path.join(temp_directory, "terms.npy"), terms)
+        np.save(os.path.join(temp_directory, "term_indices.npy"), np.array([index for term, index in short_terms], dtype=np.int64))
+        np.save(os.path.join(temp_directory, "term_table.npy"), create_term_table(terms))
+        with open(os.path.join(temp_directory, "long_terms.json"), "w", encoding="utf-8") as long_terms_io:
+            json.dump(long_terms, long_terms_io, ensure_ascii=False)
+        np.save(os.path.join(temp_directory, "classes.npy"), classes, allow_pickle=False)
+        files = {name: {"bytes": os.path.getsize(os.path.join(temp_directory, name)), "sha256": checksum_file(os.path.join(temp_directory, name))} for name in BUNDLE_FILES}
+        manifest = {"format_version": BUNDLE_FORMAT_VERSION, "version": version, "created": time.time(), "model_class": type(model).__name__,
+                    "sklearn_version": sklearn.__version__, "catboost_version": catboost.__version__, "tokenizer": settings,
+                    "vocabulary_size": len(vocabulary), "width": width, "files": files}
+        with open(os.path.join(temp_directory, "manifest.json"), "w", encoding="utf-8") as manifest_io:
+            json.dump(manifest, manifest_io, indent=2, ensure_ascii=False)
+        os.rename(temp_directory, directory)
+    except:
+        shutil.rmtree(temp_directory, ignore_errors=True)
+        raise
+    return manifest
+
+def convert_model_pickles(path_tokenizer, path_model, path_classes, directory, version=None):
+    """ 
+    Description:
+        Converts the three pickle-files read by import_model_data() into a model bundle
+    Parameters:
+        path_tokenizer (str): Full path to pickle-file
+        path_model (str): Full path to pickle-file
+        path_classes (str): Full path to pickle-file
+        directory (str): Directory of the bundle, which must not exist
+        version (str): Optional version of the model
+    Returns:
+        manifest (dic): Content of manifest.json
+    """
+    tokenizer, model, classes = import_model_data(path_tokenizer, path_model, path_classes)
+    return write_model_bundle(directory, tokenizer, model, classes, version)
+
+def read_bundle_manifest(directory, verify=False):
+    """ 
+    Description:
+        Reads the manifest of a model bundle and checks the format version and the size of every
+        file, which is cheap and catches incomplete copies. With verify, every checksum is checked too.
+    Parameters:
+        directory (str): Directory of the bundle
+        verify (bool): Whether to compare the checksums, which reads every file
+    Returns:
+        manifest (dic): Content of manifest.json
+    """
+    with open(os.path.join(directory, "manifest.json"), encoding="utf-8") as manifest_io:
+        manifest = json.load(manifest_io)
+    if manifest.get("format_version") != BUNDLE_FORMAT_VERSION:
+        raise ValueError("Unsupported model bundle format: " + str(manifest.get("format_version")))
+    for name, file in manifest["files"].items():
+        path = os.path.join(directory, name)
+        if os.path.getsize(path) != file["bytes"]:
+            raise ValueError("Model bundle file has the wrong size: " + path)
+        if verify and checksum_file(path) != file["sha256"]:
+            raise ValueError("Model bundle file has the wrong checksum: " + path)
+    return manifest
+
+def load_model_bundle(directory, verify=False):
+    """ 
+    Description:
+        Loads a model bundle written by write_model_bundle(). The vocabulary and classes are
+        memory-mapped, so they load in milliseconds and their pages are shared by all processes
+        using the bundle instead of being unpickled into every process.
+    Parameters:
+        directory (str): Directory of the bundle
+        verify (bool): Whether to compare the checksums of all files before loading
+    Returns:
+        tokenizer (dic): Compiled vectorizer used by vectorize_texts()
+        model (catboost.core.CatBoostClassifier): Model for predicting on tokenized texts
+        classes (numpy.ndarray): Object to map integers to classes
+    """
+    import catboost
+    from sklearn.feature_extraction.text import CountVectorizer
+    manifest = read_bundle_manifest(directory, verify)
+    settings = dict(manifest["tokenizer"])
+    settings["dtype"] = np.dtype(settings["dtype"]).type
+    settings["ngram_range"] = tuple(settings["ngram_range"])
+    tokenizer = compile_analyzer(CountVectorizer(**settings))
+    with open(os.path.join(directory, "long_terms.json"), encoding="utf-8") as long_terms_io:
+        long_terms = json.load(long_terms_io)
+    # Plain array views of the memory maps, since indexing a numpy.memmap is slow in the probing loop
+    tokenizer.update({"terms": np.asarray(np.load(os.path.join(directory, "terms.npy"), mmap_mode="r")),
+                      "term_indices": np.asarray(np.load(os.path.join(directory, "term_indices.npy"), mmap_mode="r")),
+                      "term_table": np.asarray(np.load(os.path.join(directory, "term_table.npy"), mmap_mode="r")),
+                      "long_terms": long_terms, "width": manifest["width"], "size": manifest["vocabulary_size"]})
+    model = getattr(catboost, manifest["model_class"])()
+    model.load_model(os.path.join(directory, "model.cbm"), format="cbm")
+    classes = np.load(os.path.join(directory, "classes.npy"), mmap_mode="r")
+    return tokenizer, model, classes
+
+##################
+### Prediction ###
+##################
+
+@instrument_fun.timed("predict_class")
 def predict_class(text, tokenizer, model, classes):
     """ 
     Description:
         Tokenizes and predicts class for text
     Parameters:
         text (str): Text to be classified
-        tokenizer (sklearn.feature_extraction.text.CountVectorizer): Tokenizer to vectorize texts
+        tokenizer (sklearn.feature_extraction.text.CountVectorizer or dic): Tokenizer or vectorizer compiled with compile_tokenizer()
         model (catboost.core.CatBoostClassifier): Model for predicting on tokenized texts
         classes (numpy.ndarray): Object to map integers to classes
     Returns:
         class (str): Class text has been predicted to be in
     """
-    vectorized_text = tokenizer.transform([text])
+    vectorized_text = vectorize_texts([text], tokenizer)
     prediction_integer = model.predict(vectorized_text)
     prediction_class = classes[int(prediction_integer.item(0))]
     
-    return prediction_class
\ No newline at end of file
+    return prediction_class
+
+def iter_predict_classes(texts, tokenizer, model, classes, chunk_size=1000, return_proba=False):
+    """ 
+    Description:
+        Tokenizes and predicts classes for an iterable of texts in chunks. Each chunk is
+        vectorized into one sparse matrix and predicted with one call to the model, and only
+        one chunk is held in memory at a time, so texts can be a generator.
+    Parameters:
+        texts (iterable): Texts to be classified
+        tokenizer (sklearn.feature_extraction.text.CountVectorizer or dic): Tokenizer or vectorizer compiled with compile_tokenizer()
+        model (catboost.core.CatBoostClassifier): Model for predicting on tokenized texts
+        classes (numpy.ndarray): Object to map integers to classes
+        chunk_size (int): Number of texts vectorized and predicted at a time
+        return_proba (bool): Whether to also return the probability of each class
+    Returns:
+        prediction_classes (numpy.ndarray): Classes predicted for the texts of a chunk
+        probabilities (numpy.ndarray): Probabilities of shape (texts in chunk, classes), only if return_proba is True
+    """
+    classes = np.asarray(classes)
+    iterator = iter(texts)
+    while True:
+        chunk = list(itertools.islice(iterator, chunk_size))
+        if not chunk:
+            break
+        with instrument_fun.span("predict_classes"):
+            vectorized_texts = vectorize_texts(chunk, tokenizer)
+            prediction_integers = np.asarray(model.predict(vectorized_texts)).reshape(-1).astype(int)
+        prediction_classes = classes[prediction_integers]
+        if return_proba:
+            yield prediction_classes, model.predict_proba(vectorized_texts)
+        else:
+            yield prediction_classes
+
+def predict_classes(texts, tokenizer, model, classes, chunk_size=1000, return_proba=False):
+    """ 
+    Description:
+        Tokenizes and predicts classes for many texts, see iter_predict_classes()
+    Parameters:
+        texts (iterable): Texts to be classified
+        tokenizer (sklearn.feature_extraction.text.CountVectorizer or dic): Tokenizer or vectorizer compiled with compile_tokenizer()
+        model (catboost.core.CatBoostClassifier): Model for predicting on tokenized texts
+        classes (numpy.ndarray): Object to map integers to classes
+        chunk_size (int): Number of texts vectorized and predicted at a time
+        return_proba (bool): Whether to also return the probability of each class
+    Returns:
+        prediction_classes (numpy.ndarray): Class predicted for each text
+        probabilities (numpy.ndarray): Probabilities of shape (texts, classes), only if return_proba is True
+    """
+    chunks = list(iter_predict_classes(texts, tokenizer, model, classes, chunk_size, return_proba))
+    if return_proba:
+        if not chunks:
+            return np.asarray(classes)[:0], np.empty((0, len(classes)))
+        return np.concatenate([chunk[0] for chunk in chunks]), np.concatenate([chunk[1] for chunk in chunks])
+    if not chunks:
+        return np.asarray(classes)[:0]
+    return np.concatenate(chunks)
+
+##############################
+### Command-line interface ###
+##############################
+
+def main(argv=None):
+    """
+    Description:
+        Command-line entry point, e.g. python email_classification_functions.py convert /models/bundle --pickles tokenizer.pkl model.pkl classes.pkl
+        or python email_classification_functions.py verify /models/bundle
+    Parameters:
+        argv (list): Command-line arguments, defaults to sys.argv
+    """
+    parser = argparse.ArgumentParser(description="Converts model pickles into a model bundle or verifies a bundle")
+    parser.add_argument("command", choices=["convert", "verify"], help="Command to run")
+    parser.add_argument("bundle", help="Directory of the model bundle")
+    parser.add_argument("--pickles", nargs=3, default=None, metavar=("TOKENIZER", "MODEL", "CLASSES"), help="Pickles to convert")
+    parser.add_argument("--version", default=None, help="Version of the model stored in the manifest")
+    args = parser.parse_args(argv)
+
+    if args.command == "convert":
+        if not args.pickles:
+            parser.error("convert requires --pickles")
+        manifest = convert_model_pickles(*args.pickles, args.bundle, args.version)
+    else:
+        manifest = read_bundle_manifest(args.bundle, verify=True)
+    print(json.dumps({name: manifest[name] for name in ["format_version", "version", "model_class", "vocabulary_size", "files"]}, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,353 @@
+import importlib.util
+import io
+import re
+import zipfile
+import zlib
+from email import message_from_bytes
+import email_unpack_functions as unpack_fun
+import email_text_extract_functions as extract_fun
+import email_instrumentation_functions as instrument_fun
+
+# Outlook msg-files are unpacked with the optional extract_msg package, imported on first use
+EXTRACT_MSG_AVAILABLE = importlib.util.find_spec("extract_msg") is not None
+
+# Limits protecting against archive bombs and deeply nested forwards
+CONTAINER_LIMITS = {"max_depth": 10, "max_total_bytes": 1024**3, "max_members": 10000, "max_member_bytes": 200*1024**2}
+
+MESSAGE_EXTENSIONS = [".eml"]
+MESSAGE_CONTENT_TYPES = ["message/rfc822"]
+OUTLOOK_EXTENSIONS = [".msg"]
+ARCHIVE_EXTENSIONS = [".zip"]
+ARCHIVE_CONTENT_TYPES = ["application/zip", "application/x-zip-compressed"]
+
+# Errors of corrupt and encrypted archives or unsupported compression, such as a corrupt deflate
+# stream (zlib.error) or a truncated member (EOFError)
+ARCHIVE_ERRORS = (zipfile.BadZipFile, RuntimeError, NotImplementedError, zlib.error, EOFError)
+
+class ContainerLimitExceeded(Exception):
+    """
+    Description:
+        Raised when unpacking would exceed one of the container limits
+    """
+
+###############
+### Budgets ###
+###############
+
+def create_budget(limits=None):
+    """
+    Description:
+        Creates the budget shared by all containers of one message
+    Parameters:
+        limits (dic): Limits overriding CONTAINER_LIMITS
+    Returns:
+        budget (dic): Limits and the bytes and members used so far
+    """
+    return {"limits": dict(CONTAINER_LIMITS, **(limits or {})), "bytes": 0, "members": 0}
+
+def charge_budget(budget, size=0, members=0):
+    """
+    Description:
+        Adds decompressed bytes and members to the budget
+    Parameters:
+        budget (dic): Budget created by create_budget()
+        size (int): Decompressed bytes
+        members (int): Number of members
+    """
+    limits = budget["limits"]
+    if budget["members"] + members > limits["max_members"]:
+        raise ContainerLimitExceeded("max_members")
+    if budget["bytes"] + size > limits["max_total_bytes"]:
+        raise ContainerLimitExceeded("max_total_bytes")
+    budget["members"] += members
+    budget["bytes"] += size
+
+def read_archive_member(archive, info, budget, chunk_size=1024**2):
+    """
+    Description:
+        Reads a member of an archive in chunks and stops as soon as a limit is exceeded.
+        The sizes stated by the archive are not trusted.
+    Parameters:
+        archive (zipfile.ZipFile): Open archive
+        info (zipfile.ZipInfo): Member to read
+        budget (dic): Budget created by create_budget()
+        chunk_size (int): Number of bytes decompressed at a time
+    Returns:
+        content (bytes): Decompressed member
+    """
+    limits = budget["limits"]
+    if info.file_size > limits["max_member_bytes"]:
+        raise ContainerLimitExceeded("max_member_bytes")
+    chunks = []
+    size = 0
+    with archive.open(info) as member_io:
+        for chunk in iter(lambda: member_io.read(chunk_size), b""):
+            size += len(chunk)
+            if size > limits["max_member_bytes"]:
+                raise ContainerLimitExceeded("max_member_bytes")
+            charge_budget(budget, len(chunk))
+            chunks.append(chunk)
+    return b"".join(chunks)
+
+#############
+### Nodes ###
+#############
+
+def create_node(name, kind, depth):
+    """
+    Description:
+        Creates a node of the tree returned by unpack_eml_tree()
+    Parameters:
+        name (str): Filename of the node or the input file for the root
+        kind (str): "message", "archive" or "file"
+        depth (int): Number of containers above the node
+    Returns:
+        node (dic): Node with empty text and no children
+    """
+    return {"name": name, "kind": kind, "depth": depth, "text": "", "children": []}
+
+def get_container_kind(file_name, content_type=None):
+    """
+    Description:
+        Decides how an attachment is unpacked from its filename and content type
+    Parameters:
+        file_name (str): Filename of attachment
+        content_type (str): Content type of attachment
+    Returns:
+        kind (str): "message", "outlook", "archive" or "file"
+    """
+    filename, fileextension = unpack_fun.get_file_name(file_name or "")
+    fileextension = fileextension.lower()
+    if fileextension in MESSAGE_EXTENSIONS or content_type in MESSAGE_CONTENT_TYPES:
+        return "message"
+    if fileextension in OUTLOOK_EXTENSIONS:
+        return "outlook"
+    if fileextension in ARCHIVE_EXTENSIONS or content_type in ARCHIVE_CONTENT_TYPES:
+        return "archive"
+    return "file"
+
+def content_to_node(name, content, depth, budget, content_type=None, cache=None):
+    """
+    Description:
+        Unpacks an attachment or archive member. Messages and archives become containers
+        with children, while other files become leaves with the text extracted by
+        attachment_content_to_text(). Limits that are exceeded are recorded under "skipped".
+    Parameters:
+        name (str): Filename
+        content (bytes): Decoded content
+        depth (int): Number of containers above the node
+        budget (dic): Budget created by create_budget()
+        content_type (str): Content type if known
+        cache (sqlite3.Connection): Optional cache opened with email_cache_functions.open_cache()
+    Returns:
+        node (dic): Node of the tree
+    """
+    kind = get_container_kind(name, content_type)
+    node = create_node(name, "file" if kind == "file" else ("archive" if kind == "archive" else "message"), depth)
+    try:
+        if kind != "file" and depth > budget["limits"]["max_depth"]:
+            raise ContainerLimitExceeded("max_depth")
+        if kind == "message":
+            return message_to_node(message_from_bytes(content), name, depth, budget, cache)
+        elif kind == "outlook" and EXTRACT_MSG_AVAILABLE:
+            return outlook_to_node(content, name, depth, budget, cache)
+        elif kind == "archive":
+            return archive_to_node(content, name, depth, budget, cache)
+        node["kind"] = "file"
+        node["text"] = extract_fun.attachment_content_to_text(name, content, cache)
+    except ContainerLimitExceeded as limit:
+        instrument_fun.increment("container_limits", limit=str(limit))
+        print("WARN: Container limit " + str(limit) + " exceeded by: " + name)
+        node["skipped"] = str(limit)
+    except ARCHIVE_ERRORS as error:
+        print("WARN: Could not unpack: " + name)
+        node["skipped"] = type(error).__name__
+    return node
+
+##################
+### Containers ###
+##################
+
+def message_to_node(message, name, depth, budget, cache=None):
+    """
+    Description:
+        Unpacks an e-mail and all of its attachments, embedded messages and archives
+    Parameters:
+        message (email.message.Message): A email message object created using the email module
+        name (str): Filename or input file of the message
+        depth (int): Number of containers above the message
+        budget (dic): Budget created by create_budget()
+        cache (sqlite3.Connection): Optional cache opened with email_cache_functions.open_cache()
+    Returns:
+        node (dic): Node with headers, text and html_text of the message and a child per attachment
+    """
+    node = create_node(name, "message", depth)
+    node["from"], node["to"], node["subject"], node["date"] = unpack_fun.get_header_data(message)
+    texts = []
+    html_texts = []
+    parts = [message]
+    while parts:
+        part = parts.pop(0)
+        content_type = part.get_content_type()
+        if part.get_filename() == "smime.p7m":
+            # Same handling of "pkcs7-mime"-files as extract_content()
+            decoded = part.get_payload(decode=True).decode("iso-8859-1")
+            parts.insert(0, message_from_bytes(re.sub(r'.*Content-Type:', 'Content-Type:', decoded).encode("iso-8859-1")))
+        elif content_type in MESSAGE_CONTENT_TYPES and part.is_multipart():
+            if depth + 1 > budget["limits"]["max_depth"]:
+                child = create_node(part.get_filename() or "message.eml", "message", depth + 1)
+                child["skipped"] = "max_depth"
+            else:
+                child = message_to_node(part.get_payload(0), part.get_filename() or "message.eml", depth + 1, budget, cache)
+            node["children"].append(child)
+        elif part.is_multipart():
+            parts[0:0] = part.get_payload()
+        elif part.get_filename():
+            file_name = unpack_fun.decode_filename(part.get_filename())
+            payload = part.get_payload(decode=True) or b""
+            try:
+                charge_budget(budget, len(payload), 1)
+            except ContainerLimitExceeded as limit:
+                child = create_node(file_name, "file", depth + 1)
+                child["skipped"] = str(limit)
+            else:
+                child = content_to_node(file_name, payload, depth + 1, budget, content_type, cache)
+            node["children"].append(child)
+        elif content_type == "text/plain":
+            texts.append(unpack_fun.decode_text_and_html_payload(part))
+        elif content_type == "text/html":
+            html_texts.append(unpack_fun.extract_text_from_html_message(part))
+    node["text"] = "".join(texts).strip()
+    node["html_text"] = "".join(html_texts)
+    return node
+
+def archive_to_node(content, name, depth, budget, cache=None):
+    """
+    Description:
+        Unpacks a zip-archive member by member in memory without extracting it to disk
+    Parameters:
+        content (bytes): The archive
+        name (str): Filename of the archive
+        depth (int): Number of containers above the archive
+        budget (dic): Budget created by create_budget()
+        cache (sqlite3.Connection): Optional cache opened with email_cache_functions.open_cache()
+    Returns:
+        node (dic): Node with a child per member
+    """
+    node = create_node(name, "archive", depth)
+    with zipfile.ZipFile(io.BytesIO(content)) as archive:
+        for info in archive.infolist():
+            if info.is_dir():
+                continue
+            child = create_node(info.filename, "file", depth + 1)
+            try:
+                charge_budget(budget, members=1)
+                member = read_archive_member(archive, info, budget)
+            except ContainerLimitExceeded as limit:
+                instrument_fun.increment("container_limits", limit=str(limit))
+                print("WARN: Container limit " + str(limit) + " exceeded by: " + name + "/" + info.filename)
+                child["skipped"] = str(limit)
+                node["children"].append(child)
+                if str(limit) != "max_member_bytes":
+                    # The budget of the whole message is spent
+                    break
+                continue
+            except ARCHIVE_ERRORS as error:
+                print("WARN: Could not unpack: " + name + "/" + info.filename)
+                child["skipped"] = type(error).__name__
+                node["children"].append(child)
+                continue
+            node["children"].append(content_to_node(info.filename, member, depth + 1, budget, cache=cache))
+    return node
+
+def outlook_to_node(content, name, depth, budget, cache=None):
+    """
+    Description:
+        Unpacks an Outlook msg-file and its attachments using extract_msg
+    Parameters:
+        content (bytes): The msg-file
+        name (str): Filename of the msg-file
+        depth (int): Number of containers above the msg-file
+        budget (dic): Budget created by create_budget()
+        cache (sqlite3.Connection): Optional cache opened with email_cache_functions.open_cache()
+    Returns:
+        node (dic): Node with headers and text of the message and a child per attachment
+    """
+    node = create_node(name, "message", depth)
+    import extract_msg
+    try:
+        outlook_message = extract_msg.Message(content)
+        try:
+            node["from"] = outlook_message.sender or ""
+            node["to"] = outlook_message.to or ""
+            node["subject"] = outlook_message.subject or ""
+            node["date"] = str(outlook_message.date or "")
+            node["text"] = (outlook_message.body or "").strip()
+            attachments = [(attachment.longFilename or attachment.shortFilename or "attachment", attachment.data) for attachment in outlook_message.attachments]
+        finally:
+            outlook_message.close()
+    except Exception as error:
+        # extract_msg and olefile raise a range of errors on corrupt msg-files, which depend on their versions
+        print("WARN: Could not unpack: " + name)
+        node["skipped"] = type(error).__name__
+        return node
+    node["html_text"] = ""
+    for file_name, data in attachments:
+        if not isinstance(data, bytes):
+            # Embedded msg-files are not unpacked further
+            child = create_node(file_name, "message", depth + 1)
+            child["skipped"] = "embedded_msg"
+        else:
+            try:
+                charge_budget(budget, len(data), 1)
+            except ContainerLimitExceeded as limit:
+                child = create_node(file_name, "file", depth + 1)
+                child["skipped"] = str(limit)
+            else:
+                child = content_to_node(file_name, data, depth + 1, budget, cache=cache)
+        node["children"].append(child)
+    return node
+
+#############################
+### Main wrapper function ###
+#############################
+
+def unpack_eml_tree(eml_file, limits=None, cache=None):
+    """
+    Description:
+        Unpacks an eml-file recursively, treating attached e-mails, msg-files and zip-archives
+        as containers. Nothing is written to disk except temporary files for textract.
+    Parameters:
+        eml_file (str): Full path to eml-file
+        limits (dic): Limits overriding CONTAINER_LIMITS, i.e. max_depth, max_total_bytes, max_members and max_member_bytes
+        cache (sqlite3.Connection): Optional cache opened with email_cache_functions.open_cache()
+    Returns:
+        tree (dic): Node of the message with its attachments as children. Every node has
+            name, kind, depth, text and children, and nodes that were not unpacked have "skipped".
+    """
+    with open(eml_file, "rb") as eml_file_io:
+        message = message_from_bytes(eml_file_io.read())
+    budget = create_budget(limits)
+    tree = message_to_node(message, eml_file, 0, budget, cache)
+    tree["bytes"] = budget["bytes"]
+    tree["members"] = budget["members"]
+    return tree
+
+def tree_to_texts(node, path=()):
+    """
+    Description:
+        Lists the texts of a tree together with the names of their parents
+    Parameters:
+        node (dic): Tree returned by unpack_eml_tree()
+        path (tuple): Names of the parents of node
+    Returns:
+        texts (list): Tuples of path and text, where path is a tuple of names from the root
+    """
+    path = path + (node["name"],)
+    texts = []
+    for key in ["subject", "text", "html_text"]:
+        if node.get(key):
+            texts.append((path, node[key]))
+    for child in node["children"]:
+        texts.extend(tree_to_texts(child, path))
+    return texts
@@ -0,0 +1,482 @@
+import binascii
+import hashlib
+import io
+import mmap
+import os
+import re
+import tempfile
+from email.parser import BytesHeaderParser, BytesParser
+import email_unpack_functions as unpack_fun
+import email_store_functions as store_fun
+import email_instrumentation_functions as instrument_fun
+
+HEADER_END_PATTERN = re.compile(rb'\r?\n\r?\n')
+
+# Encoded bodies are read and decoded this many bytes at a time
+STREAM_CHUNK_SIZE = 1024**2
+# Bytes that are not part of the base64 alphabet, which the decoder of the email package skips
+BASE64_IGNORED_BYTES = bytes(byte for byte in range(256) if byte not in b"ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/=")
+BASE64_PADDING_PATTERN = re.compile(rb'=+')
+
+#####################
+### Lazy messages ###
+#####################
+
+class LazyPart:
+    """
+    Description:
+        A part of an e-mail described by byte ranges in a memory-mapped eml-file. The headers
+        are parsed when the part is indexed, while the body is only read and decoded when
+        get_payload() or write_payload() is called.
+    Parameters:
+        data (mmap.mmap): The memory-mapped eml-file
+        header_start (int): Offset of the first header line
+        body_start (int): Offset of the body, after the blank line ending the headers
+        body_end (int): Offset just after the body
+        headers (email.message.Message): Parsed headers of the part
+    """
+    def __init__(self, data, header_start, body_start, body_end, headers):
+        self.data = data
+        self.header_start = header_start
+        self.body_start = body_start
+        self.body_end = body_end
+        self.headers = headers
+        self.children = []
+
+    def __getitem__(self, name):
+        return self.headers[name]
+
+    def get(self, name, failobj=None):
+        return self.headers.get(name, failobj)
+
+    def get_content_type(self):
+        return self.headers.get_content_type()
+
+    def get_content_charset(self, failobj=None):
+        return self.headers.get_content_charset(failobj)
+
+    def get_filename(self, failobj=None):
+        return self.headers.get_filename(failobj)
+
+    def is_multipart(self):
+        return bool(self.children)
+
+    def walk(self):
+        yield self
+        for child in self.children:
+            yield from child.walk()
+
+    def get_body_bytes(self):
+        """
+        Description:
+            Returns the raw, still encoded body of the part
+        """
+        return self.data[self.body_start:self.body_end]
+
+    def get_payload(self, decode=False):
+        """
+        Description:
+            Reads the part from the file and returns its payload like email.message.Message.get_payload()
+        Parameters:
+            decode (bool): Whether to undo the content-transfer-encoding
+        """
+        message = BytesParser().parsebytes(self.data[self.header_start:self.body_end])
+        return message.get_payload(decode=decode)
+
+    def write_payload(self, file_io, hash_name=None, chunk_size=STREAM_CHUNK_SIZE):
+        """
+        Description:
+            Decodes the body chunk by chunk from the file and writes it, such that neither the encoded
+            nor the decoded body is held in memory. Gives the same bytes as get_payload(decode=True),
+            which is used for encodings other than base64, quoted-printable, 7bit, 8bit and binary,
+            and for base64 that the streaming decoder rejects, in which case the file is rewritten.
+        Parameters:
+            file_io (_io.BufferedWriter): Seekable file opened in binary mode
+            hash_name (str): Optional name of a hashlib algorithm computed over the decoded bytes, e.g. "sha256"
+            chunk_size (int): Number of encoded bytes read at a time
+        Returns:
+            size (int): Number of decoded bytes written
+            digest (str): Hex digest of the decoded bytes or None
+        """
+        encoding = str(self.headers.get("content-transfer-encoding", "")).lower()
+        chunks = read_chunks(self.data, self.body_start, self.body_end, chunk_size)
+        if encoding == "base64":
+            decoded_chunks = decode_base64_chunks(chunks)
+        elif encoding == "quoted-printable":
+            decoded_chunks = decode_quoted_printable_chunks(chunks, chunk_size)
+        elif encoding in ("", "7bit", "8bit", "binary"):
+            decoded_chunks = chunks
+        else:
+            decoded_chunks = [self.get_payload(decode=True) or b""]
+        position = file_io.tell()
+        try:
+            size, digest = write_chunks(file_io, decoded_chunks, hash_name)
+        except binascii.Error:
+            file_io.seek(position)
+            file_io.truncate()
+            size, digest = write_chunks(file_io, [self.get_payload(decode=True) or b""], hash_name)
+        return size, digest
+
+def index_part(data, start, end, max_depth=50):
+    """
+    Description:
+        Indexes a part and, for multipart and message/rfc822 parts, its sub-parts by
+        searching the memory-mapped file for the end of headers and for boundary lines.
+    Parameters:
+        data (mmap.mmap): The memory-mapped eml-file
+        start (int): Offset of the part
+        end (int): Offset just after the part
+        max_depth (int): Maximum nesting depth that is indexed
+    Returns:
+        part (LazyPart): Indexed part
+    """
+    if data[start:start+1] in (b"\n", b"\r"):
+        # A part without headers starts with the blank line
+        body_start = data.find(b"\n", start, end) + 1
+        header_end = start
+    else:
+        match = HEADER_END_PATTERN.search(data, start, end)
+        header_end, body_start = (match.start(), match.end()) if match else (end, end)
+    headers = BytesHeaderParser().parsebytes(data[start:header_end])
+    part = LazyPart(data, start, body_start, end, headers)
+    if max_depth <= 0:
+        return part
+
+    boundary = headers.get_boundary()
+    if headers.get_content_maintype() == "multipart" and boundary:
+        delimiter = re.compile(rb'^--' + re.escape(boundary.encode("utf-8", "surrogateescape")) + rb'(--)?[ \t]*\r?$', re.MULTILINE)
+        part_start = None
+        for match in delimiter.finditer(data, body_start, end):
+            if part_start is not None:
+                # The line break before a delimiter belongs to the delimiter
+                part_end = match.start()
+                if data[part_end-1:part_end] == b"\n":
+                    part_end -= 1
+                if data[part_end-1:part_end] == b"\r":
+                    part_end -= 1
+                part.children.append(index_part(data, part_start, max(part_start, part_end), max_depth - 1))
+            if match.group(1):
+                break
+            part_start = data.find(b"\n", match.end() - 1, end) + 1 or end
+        else:
+            # A missing close delimiter ends the last part at the end of the file
+            if part_start is not None and part_start < end:
+                part.children.append(index_part(data, part_start, end, max_depth - 1))
+    elif headers.get_content_type() == "message/rfc822":
+        part.children.append(index_part(data, body_start, end, max_depth - 1))
+    return part
+
+def open_lazy_eml(eml_file):
+    """
+    Description:
+        Memory-maps an eml-file and indexes all of its parts without decoding any bodies
+    Parameters:
+        eml_file (str): Full path to eml-file
+    Returns:
+        message (LazyPart): The top-level part, whose parts are in children
+    """
+    with open(eml_file, "rb") as eml_file_io:
+        # An empty file cannot be memory-mapped, and is indexed as empty bytes instead
+        data = mmap.mmap(eml_file_io.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(eml_file_io.fileno()).st_size else b""
+    return index_part(data, 0, len(data))
+
+def close_lazy_eml(message):
+    """
+    Description:
+        Closes the memory map of a message opened with open_lazy_eml()
+    Parameters:
+        message (LazyPart): Message opened with open_lazy_eml()
+    """
+    if isinstance(message.data, mmap.mmap):
+        message.data.close()
+
+########################
+### Streaming decode ###
+########################
+
+def read_chunks(data, start, end, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Description:
+        Reads a byte range of a memory-mapped file in chunks
+    Parameters:
+        data (mmap.mmap): The memory-mapped eml-file
+        start (int): Offset of the first byte
+        end (int): Offset just after the last byte
+        chunk_size (int): Number of bytes per chunk
+    Returns:
+        chunk (bytes): Next chunk
+    """
+    for offset in range(start, end, chunk_size):
+        yield data[offset:min(offset + chunk_size, end)]
+
+def write_chunks(file_io, chunks, hash_name=None):
+    """
+    Description:
+        Writes chunks to a file, optionally hashing them on the way
+    Parameters:
+        file_io (_io.BufferedWriter): File opened in binary mode
+        chunks (iterable): Chunks of bytes
+        hash_name (str): Optional name of a hashlib algorithm
+    Returns:
+        size (int): Number of bytes written
+        digest (str): Hex digest of the bytes or None
+    """
+    digest = hashlib.new(hash_name) if hash_name else None
+    size = 0
+    for chunk in chunks:
+        file_io.write(chunk)
+        if digest is not None:
+            digest.update(chunk)
+        size += len(chunk)
+    return size, digest.hexdigest() if digest is not None else None
+
+def decode_base64_chunks(chunks):
+    """
+    Description:
+        Decodes base64 incrementally like the lenient decoder used by the email package. Bytes
+        outside the alphabet are skipped and characters that do not fill a group of four are carried
+        to the next chunk. Padding that does not complete a group is skipped, padding that does ends
+        the data, and missing padding at the end is added. Data ending in a single character, which
+        the email package returns undecoded, raises binascii.Error.
+    Parameters:
+        chunks (iterable): Encoded chunks
+    Returns:
+        chunk (bytes): Decoded chunk
+    """
+    carry = b""
+    pads = 0
+    for chunk in chunks:
+        data = chunk.translate(None, BASE64_IGNORED_BYTES)
+        start = 0
+        for padding in BASE64_PADDING_PATTERN.finditer(data):
+            if padding.start() > start:
+                carry += data[start:padding.start()]
+                pads = 0
+            pads += len(padding.group())
+            start = padding.end()
+            quad_pos = len(carry) % 4
+            if quad_pos >= 2 and quad_pos + pads >= 4:
+                yield binascii.a2b_base64(carry + b"=" * (4 - quad_pos))
+                return
+        if start < len(data):
+            carry += data[start:]
+            pads = 0
+        complete = len(carry) - len(carry) % 4
+        if complete:
+            yield binascii.a2b_base64(carry[:complete])
+            carry = carry[complete:]
+    if len(carry) == 1:
+        raise binascii.Error("Base64 data ends in a single character")
+    if carry:
+        yield binascii.a2b_base64(carry + b"=" * (4 - len(carry)))
+
+def decode_quoted_printable_chunks(chunks, max_line=STREAM_CHUNK_SIZE):
+    """
+    Description:
+        Decodes quoted-printable incrementally. Chunks are decoded up to their last line break,
+        so no escape or soft line break is split, and the rest is carried to the next chunk.
+        Lines longer than max_line are split where no escape is cut.
+    Parameters:
+        chunks (iterable): Encoded chunks
+        max_line (int): Maximum number of bytes carried to the next chunk
+    Returns:
+        chunk (bytes): Decoded chunk
+    """
+    carry = b""
+    for chunk in chunks:
+        carry += chunk
+        split = carry.rfind(b"\n") + 1
+        if not split and len(carry) > max_line:
+            # The chunk may not end in the first two bytes of an escape or a soft line break
+            split = len(carry)
+            while split and b"=" in carry[max(split - 2, 0):split]:
+                split -= 1
+        if split:
+            yield binascii.a2b_qp(carry[:split])
+            carry = carry[split:]
+    if carry:
+        yield binascii.a2b_qp(carry)
+
+def write_attachment(part, key, file_name, id, output_path, in_memory=False, spill_threshold=10*1024**2, store=None, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Description:
+        Streams an attachment of a lazy message to its destination like store_attachment() stores a
+        payload: to the output path, to the content-addressed store with its hash computed while
+        decoding, or in in-memory mode to bytes or a temporary file. Memory use is bounded by the chunk size.
+    Parameters:
+        part (LazyPart): Part of a message opened with open_lazy_eml()
+        key (str): ID string for the message
+        file_name (str): Decoded filename of attachment
+        id (str): Content-ID of attachment or None
+        output_path (str): Output path
+        in_memory (bool): Whether to keep the payload in memory instead of writing it to the output path
+        spill_threshold (int): Attachments whose encoded body is larger than this number of bytes are spilled to a temporary file
+        store (dic): Optional content-addressed store opened with email_store_functions.open_store()
+        chunk_size (int): Number of encoded bytes read at a time
+    Returns:
+        file (tuple): (path, content-ID) or in in-memory mode (name, content-ID, bytes or path to temporary file)
+    """
+    attachment_file_name = unpack_fun.create_name(key, file_name)
+    if store is not None and not in_memory:
+        file_descriptor, temp_path = tempfile.mkstemp(dir=store["directory"], suffix=".tmp")
+        try:
+            with os.fdopen(file_descriptor, "wb") as file_io:
+                size, digest = part.write_payload(file_io, "sha256", chunk_size)
+        except:
+            os.remove(temp_path)
+            raise
+        instrument_fun.increment("bytes_decoded", size)
+        blob_path, digest = store_fun.store_file(store, temp_path, key, file_name, digest)
+        return (blob_path, id)
+    if not in_memory:
+        if not unpack_fun.file_exists(output_path, attachment_file_name):
+            with open(output_path + "/" + attachment_file_name, "wb") as file_io:
+                instrument_fun.increment("bytes_decoded", part.write_payload(file_io, chunk_size=chunk_size)[0])
+        return (output_path + "/" + attachment_file_name, id)
+    if part.body_end - part.body_start > spill_threshold:
+        file_descriptor, spill_path = tempfile.mkstemp(suffix="." + attachment_file_name)
+        with os.fdopen(file_descriptor, "wb") as file_io:
+            instrument_fun.increment("bytes_decoded", part.write_payload(file_io, chunk_size=chunk_size)[0])
+        return (attachment_file_name, id, spill_path)
+    payload_io = io.BytesIO()
+    instrument_fun.increment("bytes_decoded", part.write_payload(payload_io, chunk_size=chunk_size)[0])
+    return (attachment_file_name, id, payload_io.getvalue())
+
+def extract_lazy_content(part, key, output_path, in_memory=False, spill_threshold=10*1024**2, html_engine="bs4", store=None, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Description:
+        Extracts content from a lazy message like extract_content(), but attachments are decoded
+        from the file in chunks and streamed to their destination
+    Parameters:
+        part (LazyPart): Message or part opened with open_lazy_eml()
+        key (str): ID string for the message
+        output_path (str): Output path
+        in_memory (bool): Whether to keep attachments in memory instead of writing them to the output path
+        spill_threshold (int): In in-memory mode, attachments larger than this number of bytes are spilled to a temporary file
+        html_engine (str): Engine used by extract_text_from_html_message(), "bs4" or "lxml"
+        store (dic): Optional content-addressed attachment store opened with email_store_functions.open_store()
+        chunk_size (int): Number of encoded bytes read at a time
+    Returns:
+        Text (str): All texts from all parts
+        Html (str): All HTMLs from all parts
+        Html_text (str): Text of all HTMLs
+        Files (dic): Dictionary mapping extracted files to message ID
+        Parts (int): Number of parts in the original message
+    """
+    # Handling "pkcs7-mime"-files in memory like extract_content()
+    if part.get_filename() == "smime.p7m":
+        message = BytesParser().parsebytes(part.data[part.header_start:part.body_end])
+        return unpack_fun.extract_content(message, key, output_path, in_memory, spill_threshold, html_engine, store)
+
+    Html = ""
+    Html_text = ""
+    Text = ""
+    Files = {}
+    if part.is_multipart():
+        Parts = 0
+        for child in part.children:
+            text, html, html_text, files, parts = extract_lazy_content(child, key, output_path, in_memory, spill_threshold, html_engine, store, chunk_size)
+            Text += text
+            Html += html
+            Html_text += html_text
+            Files.update(files)
+            Parts += parts
+        return Text, Html, Html_text, Files, Parts
+
+    # Handling Attachments
+    if part.get_filename():
+        file_name = unpack_fun.decode_filename(part.get_filename())
+        Files[file_name] = write_attachment(part, key, file_name, None, output_path, in_memory, spill_threshold, store, chunk_size)
+        return Text, Html, Html_text, Files, 1
+
+    # Handling other content types
+    content_type = part.get_content_type()
+    if content_type == "text/plain":
+        Text += unpack_fun.decode_text_and_html_payload(part)
+    elif content_type == "text/html":
+        Html += unpack_fun.decode_text_and_html_payload(part)
+        Html_text += unpack_fun.extract_text_from_html_message(part, engine=html_engine)
+    else:
+        content_type_header = part.get("content-type", "")
+        try:
+            id = unpack_fun.remove_square_brackets(part.get("content-id"))
+        except:
+            id = None
+
+        # Finding filename in content header
+        o = content_type_header.find("name=")
+        if o == -1:
+            return Text, Html, Html_text, Files, 1
+        ox = content_type_header.find(";", o)
+        if ox == -1:
+            ox = None
+        file_name = unpack_fun.remove_quotes(content_type_header[o+5:ox])
+        Files[file_name] = write_attachment(part, key, file_name, id, output_path, in_memory, spill_threshold, store, chunk_size)
+    return Text, Html, Html_text, Files, 1
+
+def unpack_lazy_eml(eml_file, key, output_path, in_memory=False, spill_threshold=10*1024**2, html_engine="bs4", store=None, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Description:
+        Extracts data from an eml-file like unpack_eml(), but the file is memory-mapped instead of
+        parsed and attachments are decoded in chunks, so memory use does not grow with their size
+    Parameters:
+        eml_file (str): Full path to eml-file
+        key (str): ID string for the message
+        output_path (str): Output path, not used in in-memory mode
+        in_memory (bool): Whether to keep attachments in memory instead of writing them to the output path
+        spill_threshold (int): In in-memory mode, attachments larger than this number of bytes are spilled to a temporary file
+        html_engine (str): Engine used to extract text from HTML, "bs4" or "lxml"
+        store (dic): Optional content-addressed attachment store opened with email_store_functions.open_store()
+        chunk_size (int): Number of encoded bytes read at a time
+    Returns:
+        msg (dic): A dictionary with file text and attachments is returned
+    """
+    message = open_lazy_eml(eml_file)
+    try:
+        From, To, Subject, Date = unpack_fun.get_header_data(message.headers)
+        with instrument_fun.span("extract_content"):
+            Text, Html, Html_text, Files, Parts = extract_lazy_content(message, key, output_path, in_memory, spill_threshold, html_engine, store, chunk_size)
+    finally:
+        close_lazy_eml(message)
+    unpacked_eml = {"input_file": eml_file, "subject": Subject, "from": From, "to": To, "date": Date, "text": Text.strip(), "html": Html.strip(), "html_text": Html_text, "parts": Parts}
+    if Files:
+        unpacked_eml["files"] = Files
+    return unpacked_eml
+
+#################################
+### Retrieval from lazy parts ###
+#################################
+
+def get_lazy_text(message, content_type="text/plain"):
+    """
+    Description:
+        Decodes only the text parts of a lazy message, skipping attachments and all other parts
+    Parameters:
+        message (LazyPart): Message opened with open_lazy_eml()
+        content_type (str): Content type of the parts to decode, e.g. "text/plain" or "text/html"
+    Returns:
+        text (str): Concatenated text of the parts
+    """
+    texts = []
+    for part in message.walk():
+        if part.is_multipart() or part.get_filename() or part.get_content_type() != content_type:
+            continue
+        texts.append(unpack_fun.decode_text_and_html_payload(part))
+    return "".join(texts).strip()
+
+def unpack_eml_headers_and_text(eml_file):
+    """
+    Description:
+        Reads headers and plain-text body of an eml-file without decoding its attachments
+    Parameters:
+        eml_file (str): Full path to eml-file
+    Returns:
+        msg (dic): A dictionary with input_file, subject, from, to, date and text
+    """
+    message = open_lazy_eml(eml_file)
+    try:
+        From, To, Subject, Date = unpack_fun.get_header_data(message.headers)
+        Text = get_lazy_text(message)
+    finally:
+        close_lazy_eml(message)
+    return {"input_file": eml_file, "subject": Subject, "from": From, "to": To, "date": Date, "text": Text}
@@ -0,0 +1,214 @@
+import contextlib
+import functools
+import json
+import os
+import threading
+import time
+
+# Instrumentation is disabled by default, in which case spans and counters cost a single check
+state = {"enabled": False, "span_log": None}
+timers = {}
+counters = {}
+lock = threading.Lock()
+
+#####################
+### Configuration ###
+#####################
+
+def enable_instrumentation(span_log=None):
+    """
+    Description:
+        Turns on timers and counters for the current process
+    Parameters:
+        span_log (str): Optional path to a file where every span is appended as a JSON line
+    """
+    disable_instrumentation()
+    if span_log:
+        state["span_log"] = open(span_log, "a", buffering=1)
+    state["enabled"] = True
+
+def disable_instrumentation():
+    """
+    Description:
+        Turns off timers and counters and closes the span log. Recorded values are kept.
+    """
+    state["enabled"] = False
+    if state["span_log"] is not None:
+        state["span_log"].close()
+        state["span_log"] = None
+
+def reset_instrumentation():
+    """
+    Description:
+        Clears all recorded timers and counters
+    """
+    with lock:
+        timers.clear()
+        counters.clear()
+
+def label_key(name, labels):
+    """
+    Description:
+        Creates a hashable key from a metric name and its labels
+    Parameters:
+        name (str): Metric name
+        labels (dic): Labels such as {"type": ".pdf"}
+    Returns:
+        key (tuple): Name followed by sorted label pairs
+    """
+    return (name,) + tuple(sorted(labels.items()))
+
+##########################
+### Spans and counters ###
+##########################
+
+def record_span(name, seconds, labels):
+    """
+    Description:
+        Adds a finished span to the timers and the span log
+    Parameters:
+        name (str): Name of span, e.g. "unpack_eml"
+        seconds (float): Duration of span
+        labels (dic): Labels of span
+    """
+    key = label_key(name, labels)
+    with lock:
+        timer = timers.setdefault(key, [0, 0.0, 0.0])
+        timer[0] += 1
+        timer[1] += seconds
+        timer[2] = max(timer[2], seconds)
+        if state["span_log"] is not None:
+            state["span_log"].write(json.dumps({"time": time.time(), "pid": os.getpid(), "span": name, "seconds": seconds, "labels": labels}) + "\n")
+
+@contextlib.contextmanager
+def recording_span(name, labels):
+    """
+    Description:
+        Context manager used by span() when instrumentation is enabled
+    Parameters:
+        name (str): Name of span
+        labels (dic): Labels of span
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_span(name, time.perf_counter() - start, labels)
+
+def span(name, **labels):
+    """
+    Description:
+        Times a block of code, e.g. with span("attachment_to_text", branch="ocr"): ...
+    Parameters:
+        name (str): Name of span
+        labels (dic): Labels of span as keyword arguments
+    Returns:
+        context (contextmanager): Context manager timing the block, a no-op when disabled
+    """
+    if not state["enabled"]:
+        return contextlib.nullcontext()
+    return recording_span(name, labels)
+
+def timed(name):
+    """
+    Description:
+        Decorator timing every call of a function as a span
+    Parameters:
+        name (str): Name of span
+    Returns:
+        decorator (function): Decorator
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not state["enabled"]:
+                return function(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                record_span(name, time.perf_counter() - start, {})
+        return wrapper
+    return decorator
+
+def increment(name, value=1, **labels):
+    """
+    Description:
+        Increments a counter, e.g. increment("attachments", type=".pdf")
+    Parameters:
+        name (str): Name of counter
+        value (int): Value to add
+        labels (dic): Labels of counter as keyword arguments
+    """
+    if not state["enabled"]:
+        return
+    key = label_key(name, labels)
+    with lock:
+        counters[key] = counters.get(key, 0) + value
+
+##############
+### Export ###
+##############
+
+def snapshot():
+    """
+    Description:
+        Returns the recorded timers and counters
+    Returns:
+        snapshot (dic): Lists of timers and counters with their labels
+    """
+    with lock:
+        return {
+            "pid": os.getpid(),
+            "timers": [{"name": key[0], "labels": dict(key[1:]), "count": timer[0], "seconds": timer[1], "max_seconds": timer[2]} for key, timer in sorted(timers.items())],
+            "counters": [{"name": key[0], "labels": dict(key[1:]), "value": value} for key, value in sorted(counters.items())],
+        }
+
+def export_json(path):
+    """
+    Description:
+        Appends a snapshot of timers and counters to a file as one JSON line
+    Parameters:
+        path (str): Path to log file
+    """
+    with open(path, "a") as log_io:
+        log_io.write(json.dumps(dict(snapshot(), time=time.time())) + "\n")
+
+def format_labels(labels):
+    """
+    Description:
+        Formats labels in the Prometheus text format
+    Parameters:
+        labels (dic): Labels
+    Returns:
+        labels (str): E.g. {stage="unpack_eml",type=".pdf"}
+    """
+    if not labels:
+        return ""
+    escaped = [(key, str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')) for key, value in sorted(labels.items())]
+    return "{" + ",".join('%s="%s"' % pair for pair in escaped) + "}"
+
+def export_prometheus(path, prefix="emltext"):
+    """
+    Description:
+        Writes timers and counters in the Prometheus text format, e.g. for the node exporter's textfile collector.
+        The file is replaced atomically.
+    Parameters:
+        path (str): Path to .prom-file
+        prefix (str): Prefix of metric names
+    """
+    data = snapshot()
+    lines = []
+    lines.append("# TYPE %s_span_seconds_total counter" % prefix)
+    lines.extend("%s_span_seconds_total%s %r" % (prefix, format_labels(dict(timer["labels"], span=timer["name"])), timer["seconds"]) for timer in data["timers"])
+    lines.append("# TYPE %s_span_calls_total counter" % prefix)
+    lines.extend("%s_span_calls_total%s %d" % (prefix, format_labels(dict(timer["labels"], span=timer["name"])), timer["count"]) for timer in data["timers"])
+    lines.append("# TYPE %s_span_max_seconds gauge" % prefix)
+    lines.extend("%s_span_max_seconds%s %r" % (prefix, format_labels(dict(timer["labels"], span=timer["name"])), timer["max_seconds"]) for timer in data["timers"])
+    for name in sorted(set(counter["name"] for counter in data["counters"])):
+        lines.append("# TYPE %s_%s_total counter" % (prefix, name))
+        lines.extend("%s_%s_total%s %d" % (prefix, name, format_labels(counter["labels"]), counter["value"]) for counter in data["counters"] if counter["name"] == name)
+    temp_path = path + ".tmp"
+    with open(temp_path, "w") as prom_io:
+        prom_io.write("\n".join(lines) + "\n")
+    os.replace(temp_path, path)
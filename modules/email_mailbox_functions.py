@@ -0,0 +1,142 @@
+import os
+import re
+from email.parser import BytesFeedParser, BytesParser
+import email_unpack_functions as unpack_fun
+import email_text_extract_functions as extract_fun
+
+####################
+### Message keys ###
+####################
+
+def create_message_key(message, fallback):
+    """
+    Description:
+        Creates a stable key for a message from its Message-ID, falling back to its
+        position in the mailbox. The key is safe to use in file names.
+    Parameters:
+        message (email.message.Message): A email message object created using the email module
+        fallback (str): Key used when the message has no Message-ID, e.g. mailbox name and offset
+    Returns:
+        key (str): Key for the message
+    """
+    message_id = message.get("message-id")
+    key = unpack_fun.remove_square_brackets(str(message_id)) if message_id else fallback
+    return re.sub(r'[^\w.@-]', '_', key)
+
+#######################
+### Mailbox readers ###
+#######################
+
+def iter_mbox_messages(path):
+    """
+    Description:
+        Reads an mbox-file one message at a time. The file is read line by line in binary
+        mode and each message is built with a feed parser, so memory use is bounded by the
+        largest message and not by the size of the mailbox. Like the mailbox module every
+        line starting with "From " starts a new message.
+    Parameters:
+        path (str): Full path to mbox-file
+    Returns:
+        offset (int): Byte offset of the "From " line of the message
+        message (email.message.Message): Parsed message
+    """
+    with open(path, "rb") as mbox_io:
+        parser = None
+        start = 0
+        offset = 0
+        previous_line = None
+        for line in mbox_io:
+            if line.startswith(b"From "):
+                if parser is not None:
+                    # The blank line before "From " separates messages and is not part of them
+                    if previous_line is not None and previous_line not in (b"\n", b"\r\n"):
+                        parser.feed(previous_line)
+                    yield start, parser.close()
+                parser = BytesFeedParser()
+                start = offset
+                previous_line = None
+            elif parser is not None:
+                if previous_line is not None:
+                    parser.feed(previous_line)
+                previous_line = line
+            offset += len(line)
+        if parser is not None:
+            if previous_line is not None and previous_line not in (b"\n", b"\r\n"):
+                parser.feed(previous_line)
+            yield start, parser.close()
+
+def list_maildir_files(directory):
+    """
+    Description:
+        Lists the message files of a Maildir and its Maildir++ subfolders in a stable order
+    Parameters:
+        directory (str): Root directory of the Maildir
+    Returns:
+        paths (list): Full paths to message files
+    """
+    paths = []
+    for root, folders, files in os.walk(directory):
+        folders.sort()
+        if os.path.basename(root) in ("cur", "new"):
+            paths.extend(os.path.join(root, filename) for filename in sorted(files) if not filename.startswith("."))
+    return paths
+
+def iter_maildir_messages(directory):
+    """
+    Description:
+        Reads a Maildir one message at a time
+    Parameters:
+        directory (str): Root directory of the Maildir
+    Returns:
+        path (str): Full path to message file
+        message (email.message.Message): Parsed message
+    """
+    parser = BytesParser()
+    for path in list_maildir_files(directory):
+        with open(path, "rb") as message_io:
+            yield path, parser.parse(message_io)
+
+def iter_mailbox_messages(path):
+    """
+    Description:
+        Reads a Maildir (if path is a directory) or an mbox-file one message at a time
+    Parameters:
+        path (str): Full path to mbox-file or Maildir
+    Returns:
+        key (str): Stable key for the message
+        input_file (str): Where the message was read from, i.e. Maildir file or mbox-file and offset
+        message (email.message.Message): Parsed message
+    """
+    if os.path.isdir(path):
+        for file_path, message in iter_maildir_messages(path):
+            fallback = os.path.basename(file_path).split(":")[0]
+            yield create_message_key(message, fallback), file_path, message
+    else:
+        mailbox_name, mailbox_extension = unpack_fun.get_file_name(path)
+        for offset, message in iter_mbox_messages(path):
+            fallback = mailbox_name + "." + str(offset)
+            yield create_message_key(message, fallback), path + ":" + str(offset), message
+
+#############################
+### Main wrapper function ###
+#############################
+
+def unpack_mailbox(path, output_path, extract_attachments=True, in_memory=False, cache=None):
+    """
+    Description:
+        Unpacks every message of an mbox-file or Maildir with the same functions as unpack_eml()
+        and unpack_attachments(), one message at a time.
+    Parameters:
+        path (str): Full path to mbox-file or Maildir
+        output_path (str): Output path for attachments, not used in in-memory mode
+        extract_attachments (bool): Whether to extract the texts of attachments with unpack_attachments()
+        in_memory (bool): Whether to keep attachments in memory instead of writing them to the output path
+        cache (sqlite3.Connection): Optional cache opened with email_cache_functions.open_cache()
+    Returns:
+        unpack_dic (dic): Dictionary in the format output by unpack_eml() or unpack_attachments() for each message
+    """
+    for key, input_file, message in iter_mailbox_messages(path):
+        unpack_dic = unpack_fun.unpack_message(message, input_file, key, output_path, in_memory)
+        if extract_attachments:
+            unpack_dic = extract_fun.unpack_attachments(unpack_dic, cache)
+        yield unpack_dic
@@ -0,0 +1,239 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+import email_unpack_functions as unpack_fun
+import email_text_extract_functions as extract_fun
+import email_store_functions as store_fun
+import email_instrumentation_functions as instrument_fun
+
+# Bumping the version of a stage reprocesses that stage and all later stages
+PIPELINE_VERSION = 1
+STAGE_VERSIONS = {"extract": 1, "clean": 1}
+
+# Settings of each stage, the clean stage only runs when keys are given. Streaming gives the same
+# result, so it is not part of the fingerprint of the extract stage. The directory of the attachment
+# store is, since the result points to files in it.
+DEFAULT_SETTINGS = {"html_engine": "bs4", "attachment_timeout": None, "message_timeout": None, "keys": None, "cleaning": {}, "streaming": False}
+STAGE_SETTINGS = {"extract": ["html_engine", "attachment_timeout", "message_timeout", "store"], "clean": ["keys", "cleaning"]}
+
+################
+### Manifest ###
+################
+
+def open_manifest(path):
+    """
+    Description:
+        Opens (and creates if needed) a manifest of processed e-mails. For every input file it records
+        size, modification time and hash, and for every stage the settings it was processed with and
+        where the result was written. The manifest can be shared by several processes.
+    Parameters:
+        path (str): Full path to the SQLite file
+    Returns:
+        manifest (sqlite3.Connection): Connection to the manifest
+    """
+    manifest = sqlite3.connect(path, timeout=60)
+    manifest.execute("PRAGMA journal_mode=WAL")
+    manifest.execute("CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, hash TEXT NOT NULL)")
+    manifest.execute("CREATE TABLE IF NOT EXISTS stages (path TEXT NOT NULL, stage TEXT NOT NULL, fingerprint TEXT NOT NULL, output TEXT NOT NULL, updated REAL NOT NULL, PRIMARY KEY (path, stage))")
+    manifest.commit()
+    return manifest
+
+def hash_file(path, chunk_size=1024**2):
+    """
+    Description:
+        Computes the SHA-256 hash of a file
+    Parameters:
+        path (str): Full path to file
+        chunk_size (int): Number of bytes hashed at a time
+    Returns:
+        digest (str): Hex digest
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as file_io:
+        for chunk in iter(lambda: file_io.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def check_input_file(manifest, path):
+    """
+    Description:
+        Checks whether an input file changed since it was last processed. The file is only hashed
+        when its size or modification time changed, such that unchanged files cost a single stat.
+        The stages of a changed file are removed from the manifest.
+    Parameters:
+        manifest (sqlite3.Connection): Connection to the manifest
+        path (str): Full path to input file
+    Returns:
+        changed (bool): Whether the file is new or its content changed
+    """
+    stat = os.stat(path)
+    row = manifest.execute("SELECT size, mtime_ns, hash FROM files WHERE path = ?", (path,)).fetchone()
+    if row is not None and row[0] == stat.st_size and row[1] == stat.st_mtime_ns:
+        return False
+    digest = hash_file(path)
+    with manifest:
+        manifest.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)", (path, stat.st_size, stat.st_mtime_ns, digest))
+        if row is not None and row[2] == digest:
+            # Only touched, e.g. by a copy that kept the content
+            return False
+        manifest.execute("DELETE FROM stages WHERE path = ?", (path,))
+    return True
+
+def create_fingerprint(stage, settings, upstream=""):
+    """
+    Description:
+        Creates a fingerprint of a stage from the pipeline version, the version and settings of
+        the stage and the fingerprint of the stage before it
+    Parameters:
+        stage (str): "extract" or "clean"
+        settings (dic): Settings of the pipeline, see DEFAULT_SETTINGS
+        upstream (str): Fingerprint of the previous stage
+    Returns:
+        fingerprint (str): Hex digest
+    """
+    stage_settings = {name: settings.get(name) for name in STAGE_SETTINGS[stage]}
+    if stage == "extract":
+        stage_settings["ocr_engine"] = extract_fun.ocr_settings["engine"]
+        stage_settings["pdf"] = dict(extract_fun.pdf_settings)
+    content = json.dumps([PIPELINE_VERSION, stage, STAGE_VERSIONS[stage], stage_settings, upstream], sort_keys=True, default=str)
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+def get_stage(manifest, path, stage, fingerprint):
+    """
+    Description:
+        Looks up the result of a stage processed with the same fingerprint
+    Parameters:
+        manifest (sqlite3.Connection): Connection to the manifest
+        path (str): Full path to input file
+        stage (str): "extract" or "clean"
+        fingerprint (str): Fingerprint created by create_fingerprint()
+    Returns:
+        output (str): Path to the result or None if the stage must be processed
+    """
+    row = manifest.execute("SELECT output FROM stages WHERE path = ? AND stage = ? AND fingerprint = ?", (path, stage, fingerprint)).fetchone()
+    if row is None or not os.path.exists(row[0]):
+        return None
+    return row[0]
+
+def record_stage(manifest, path, stage, fingerprint, output):
+    """
+    Description:
+        Records that a stage is done. This is the checkpoint a later run resumes from.
+    Parameters:
+        manifest (sqlite3.Connection): Connection to the manifest
+        path (str): Full path to input file
+        stage (str): "extract" or "clean"
+        fingerprint (str): Fingerprint created by create_fingerprint()
+        output (str): Path to the result
+    """
+    with manifest:
+        manifest.execute("INSERT OR REPLACE INTO stages VALUES (?, ?, ?, ?, ?)", (path, stage, fingerprint, output, time.time()))
+
+#####################
+### Stage results ###
+#####################
+
+def create_result_path(output_path, eml_file, stage):
+    """
+    Description:
+        Creates the path of a stage result. The hash of the input path keeps results of
+        equally named files in different folders apart.
+    Parameters:
+        output_path (str): Output path
+        eml_file (str): Full path to eml-file
+        stage (str): "extract" or "clean"
+    Returns:
+        path (str): Full path to JSON-file
+    """
+    return os.path.join(output_path, "results", store_fun.create_message_key(eml_file) + "." + stage + ".json")
+
+def write_result(path, result):
+    """
+    Description:
+        Writes a stage result as JSON, replacing the file atomically
+    Parameters:
+        path (str): Full path to JSON-file
+        result (dic): Result
+    """
+    unpack_fun.make_directory(os.path.dirname(path))
+    temp_path = path + ".tmp"
+    with open(temp_path, "w", encoding="utf-8") as result_io:
+        json.dump(result, result_io, ensure_ascii=False, default=str)
+    os.replace(temp_path, path)
+
+def read_result(path):
+    """
+    Description:
+        Reads a stage result written by write_result()
+    Parameters:
+        path (str): Full path to JSON-file
+    Returns:
+        result (dic): Result
+    """
+    with open(path, encoding="utf-8") as result_io:
+        return json.load(result_io)
+
+#############################
+### Main wrapper function ###
+#############################
+
+def process_eml_incremental(eml_file, output_path, manifest, settings=None, cache=None, store=None):
+    """
+    Description:
+        Unpacks an eml-file, extracts the texts of its attachments and, if keys are given, cleans
+        the text, skipping every stage whose input and settings did not change since the last run.
+        Changing cleaning settings only reprocesses the clean stage and never the extraction.
+        Stages are not recorded when an attachment timed out, such that the next run retries them.
+    Parameters:
+        eml_file (str): Full path to eml-file
+        output_path (str): Output path for attachments and stage results
+        manifest (sqlite3.Connection): Manifest opened with open_manifest()
+        settings (dic): Settings overriding DEFAULT_SETTINGS. "cleaning" holds the flags of collect_and_clean_text().
+        cache (sqlite3.Connection): Optional cache opened with email_cache_functions.open_cache()
+        store (dic): Optional content-addressed attachment store opened with email_store_functions.open_store()
+    Returns:
+        unpack_dic (dic): Dictionary output by unpack_attachments(), with "clean_text" if keys are given
+        stages (list): Stages that were processed, empty if nothing changed
+    """
+    settings = dict(DEFAULT_SETTINGS, **(settings or {}))
+    settings["store"] = os.path.abspath(store["directory"]) if store is not None else None
+    check_input_file(manifest, eml_file)
+    stages = []
+
+    fingerprint = create_fingerprint("extract", settings)
+    output = get_stage(manifest, eml_file, "extract", fingerprint)
+    if output is not None:
+        unpack_dic = read_result(output)
+    else:
+        key, fileextension = unpack_fun.get_file_name(eml_file)
+        if store is not None:
+            # Drop the references of an earlier extraction, unpack_eml() adds the current ones again.
+            # The key includes the path, such that equally named files in other folders keep theirs.
+            key = store_fun.create_message_key(eml_file)
+            store_fun.release_message(store, key)
+        unpack_dic = unpack_fun.unpack_eml(eml_file, key, output_path, html_engine=settings["html_engine"], store=store, streaming=settings["streaming"])
+        unpack_dic = extract_fun.unpack_attachments(unpack_dic, cache, settings["attachment_timeout"], settings["message_timeout"])
+        output = create_result_path(output_path, eml_file, "extract")
+        write_result(output, unpack_dic)
+        if not unpack_dic.get("timed_out"):
+            record_stage(manifest, eml_file, "extract", fingerprint, output)
+        stages.append("extract")
+
+    if settings["keys"]:
+        fingerprint = create_fingerprint("clean", settings, fingerprint)
+        output = get_stage(manifest, eml_file, "clean", fingerprint)
+        if output is not None:
+            unpack_dic["clean_text"] = read_result(output)["clean_text"]
+        else:
+            filename, unpack_dic["clean_text"] = extract_fun.collect_and_clean_text(unpack_dic, settings["keys"], **settings["cleaning"])
+            output = create_result_path(output_path, eml_file, "clean")
+            write_result(output, {"input_file": eml_file, "clean_text": unpack_dic["clean_text"]})
+            if not unpack_dic.get("timed_out"):
+                # The fingerprint does not change when the extraction is retried, so a clean text of a partial extraction is never reused
+                record_stage(manifest, eml_file, "clean", fingerprint, output)
+            stages.append("clean")
+
+    instrument_fun.increment("incremental_messages", result="processed" if stages else "unchanged")
+    return unpack_dic, stages
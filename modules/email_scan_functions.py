@@ -0,0 +1,219 @@
+import argparse
+import functools
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from email.parser import BytesHeaderParser
+import email_unpack_functions as unpack_fun
+import email_mailbox_functions as mailbox_fun
+
+# Headers scanned by default, and headers whose e-mail address is also returned
+DEFAULT_HEADERS = ["from", "to", "subject", "date"]
+ADDRESS_HEADERS = ["from", "to", "cc", "bcc", "reply-to", "sender"]
+
+###########################
+### Header-only reading ###
+###########################
+
+def read_header_block(file_io):
+    """
+    Description:
+        Reads the top-level header block of a message and stops at the blank line ending it,
+        such that the body is never read
+    Parameters:
+        file_io (_io.BufferedReader): File opened in binary mode at the start of the headers
+    Returns:
+        block (bytes): Header lines
+    """
+    lines = []
+    for line in file_io:
+        if line in (b"\n", b"\r\n"):
+            break
+        lines.append(line)
+    return b"".join(lines)
+
+@functools.lru_cache(maxsize=100000)
+def decode_header_value(value):
+    """
+    Description:
+        Decodes a header value with decode_header_string(), memoized because the same encoded
+        senders, recipients and subjects recur across many messages
+    Parameters:
+        value (str): Raw header value
+    Returns:
+        value (str): Decoded value
+    """
+    return unpack_fun.decode_header_string(value.strip())
+
+@functools.lru_cache(maxsize=100000)
+def get_cached_email_address(value):
+    """
+    Description:
+        Memoized get_email_address()
+    Parameters:
+        value (str): Decoded To/From string
+    Returns:
+        address (str): E-mail address
+    """
+    return unpack_fun.get_email_address(value)
+
+def decode_headers(block, headers=DEFAULT_HEADERS):
+    """
+    Description:
+        Parses a header block and decodes only the requested headers. For address headers the
+        e-mail address is added as "<header>_address".
+    Parameters:
+        block (bytes): Header lines read by read_header_block()
+        headers (list): Lower-case names of the headers to decode
+    Returns:
+        values (dic): Decoded headers, empty strings for missing headers like get_header_data()
+    """
+    message = BytesHeaderParser().parsebytes(block)
+    values = {}
+    for header in headers:
+        value = message[header]
+        values[header] = decode_header_value(str(value)) if value else ""
+        if header in ADDRESS_HEADERS:
+            values[header + "_address"] = get_cached_email_address(values[header]) if values[header] else ""
+    return values
+
+def scan_eml_headers(eml_file, headers=DEFAULT_HEADERS):
+    """
+    Description:
+        Reads the requested headers of an eml-file without parsing its body
+    Parameters:
+        eml_file (str): Full path to eml-file
+        headers (list): Lower-case names of the headers to decode
+    Returns:
+        values (dic): input_file and the decoded headers, or input_file and error if the file could not be read
+    """
+    try:
+        with open(eml_file, "rb") as eml_file_io:
+            block = read_header_block(eml_file_io)
+        return dict(decode_headers(block, headers), input_file=eml_file)
+    except Exception as error:
+        return {"input_file": eml_file, "error": repr(error)}
+
+def scan_eml_chunk(eml_files, headers=DEFAULT_HEADERS):
+    """
+    Description:
+        Scans a list of eml-files in one worker, such that each task covers many small files
+    Parameters:
+        eml_files (list): Full paths to eml-files
+        headers (list): Lower-case names of the headers to decode
+    Returns:
+        values (list): Result of scan_eml_headers() for each file
+    """
+    return [scan_eml_headers(eml_file, headers) for eml_file in eml_files]
+
+def scan_mbox_message(block, input_file, headers=DEFAULT_HEADERS):
+    """
+    Description:
+        Decodes the headers of one message of an mbox-file, such that a bad header does not end the scan
+    Parameters:
+        block (list): Header lines of the message
+        input_file (str): Path and offset of the message
+        headers (list): Lower-case names of the headers to decode
+    Returns:
+        values (dic): input_file and the decoded headers, or input_file and error if the headers could not be decoded
+    """
+    try:
+        return dict(decode_headers(b"".join(block), headers), input_file=input_file)
+    except Exception as error:
+        return {"input_file": input_file, "error": repr(error)}
+
+def scan_mbox_headers(path, headers=DEFAULT_HEADERS):
+    """
+    Description:
+        Reads the requested headers of every message in an mbox-file. Body lines are skipped
+        without being parsed, splitting messages on "From " lines like iter_mbox_messages().
+    Parameters:
+        path (str): Full path to mbox-file
+        headers (list): Lower-case names of the headers to decode
+    Returns:
+        values (dic): input_file as path and offset, and the decoded headers or error for each message
+    """
+    with open(path, "rb") as mbox_io:
+        offset = 0
+        start = None
+        block = None
+        for line in mbox_io:
+            if line.startswith(b"From "):
+                if block is not None:
+                    yield scan_mbox_message(block, path + ":" + str(start), headers)
+                start = offset
+                block = []
+                in_headers = True
+            elif block is not None and in_headers:
+                if line in (b"\n", b"\r\n"):
+                    in_headers = False
+                else:
+                    block.append(line)
+            offset += len(line)
+        if block is not None:
+            yield scan_mbox_message(block, path + ":" + str(start), headers)
+
+#########################
+### Parallel scanning ###
+#########################
+
+def scan_headers(path, headers=DEFAULT_HEADERS, extension="eml", recursive=False, workers=None, chunk_size=1000):
+    """
+    Description:
+        Scans the headers of a directory of eml-files, a Maildir or an mbox-file. Files are
+        scanned in parallel in chunks, while an mbox-file is read sequentially, since reading
+        a single file is bound by I/O.
+    Parameters:
+        path (str): Directory with eml-files, Maildir or mbox-file
+        headers (list): Lower-case names of the headers to decode
+        extension (str): File extension of the e-mails in a directory
+        recursive (bool): Whether to include files in subfolders
+        workers (int): Number of worker processes, defaults to the number of CPUs
+        chunk_size (int): Number of files per task
+    Returns:
+        values (dic): input_file and the decoded headers for each message
+    """
+    headers = [header.lower() for header in headers]
+    if not os.path.isdir(path):
+        yield from scan_mbox_headers(path, headers)
+        return
+    if os.path.isdir(os.path.join(path, "cur")) or os.path.isdir(os.path.join(path, "new")):
+        eml_files = mailbox_fun.list_maildir_files(path)
+    else:
+        eml_files = unpack_fun.list_files(path, extension, recursive)
+    chunks = [eml_files[i:i+chunk_size] for i in range(0, len(eml_files), chunk_size)]
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count() or 1) as executor:
+        for values in executor.map(scan_eml_chunk, chunks, [headers] * len(chunks)):
+            yield from values
+
+##############################
+### Command-line interface ###
+##############################
+
+def main(argv=None):
+    """
+    Description:
+        Command-line entry point, e.g. python email_scan_functions.py /mnt/emls --headers from subject > headers.jsonl
+    Parameters:
+        argv (list): Command-line arguments, defaults to sys.argv
+    """
+    parser = argparse.ArgumentParser(description="Scans the headers of e-mails without parsing their bodies and writes them as JSON lines")
+    parser.add_argument("path", help="Directory with eml-files, Maildir or mbox-file")
+    parser.add_argument("--headers", nargs="*", default=DEFAULT_HEADERS, help="Headers to decode")
+    parser.add_argument("--extension", default="eml", help="File extension of the e-mails")
+    parser.add_argument("--recursive", action="store_true", help="Include files in subfolders")
+    parser.add_argument("--workers", type=int, default=None, help="Number of worker processes")
+    parser.add_argument("--output", default=None, help="Write the JSON lines to this file instead of stdout")
+    args = parser.parse_args(argv)
+
+    output_io = open(args.output, "w", encoding="utf-8") if args.output else sys.stdout
+    try:
+        for values in scan_headers(args.path, args.headers, args.extension, args.recursive, args.workers):
+            output_io.write(json.dumps(values, ensure_ascii=False) + "\n")
+    finally:
+        if args.output:
+            output_io.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,444 @@
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from email import message_from_bytes
+import email_unpack_functions as unpack_fun
+import email_text_extract_functions as extract_fun
+import email_cache_functions as cache_fun
+
+# State of a worker process, filled once by initialize_worker()
+worker_state = {}
+
+# Workers are forked from a single-threaded server process, since forking the service, whose
+# pool and event loop run threads, may deadlock the new workers when a pool is replaced
+WORKER_START_METHOD = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else None
+
+HTTP_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 413: "Payload Too Large", 500: "Internal Server Error", 503: "Service Unavailable"}
+
+######################
+### Worker process ###
+######################
+
+def initialize_worker(output_path, model_paths=None, cache_path=None, attachment_timeout=None, message_timeout=None, workers=1):
+    """
+    Description:
+        Runs once in every worker process. The HTML parsers, which the modules import on first
+        use, are imported here, the models are loaded and the cache is opened, which keeps requests
+        warm. A model bundle is memory-mapped, so its vocabulary is shared by the workers. Pages are
+        OCR'ed on the worker's share of the CPUs.
+    Parameters:
+        output_path (str): Output path for attachments of requests given by path
+        model_paths (tuple): Optional path to a model bundle or paths to tokenizer, model and classes pickles
+        cache_path (str): Optional path to a text cache shared by the workers
+        attachment_timeout (float): Maximum seconds spent on a single attachment
+        message_timeout (float): Maximum seconds spent on all attachments of a message
+        workers (int): Number of worker processes sharing the CPUs
+    """
+    import bs4
+    import lxml.etree
+    extract_fun.set_ocr_workers(processes=workers)
+    worker_state["output_path"] = output_path
+    worker_state["timeouts"] = (attachment_timeout, message_timeout)
+    worker_state["cache"] = cache_fun.open_cache(cache_path) if cache_path else None
+    worker_state["models"] = None
+    if model_paths:
+        import email_classification_functions as classification_fun
+        worker_state["classification_fun"] = classification_fun
+        worker_state["models"] = classification_fun.load_model_data(model_paths)
+
+def warm_up_worker(seconds=0.1):
+    """
+    Description:
+        Keeps a worker busy for a moment, such that warming up the pool reaches every process
+    Parameters:
+        seconds (float): Seconds to sleep
+    Returns:
+        pid (int): Process ID of worker
+    """
+    time.sleep(seconds)
+    return os.getpid()
+
+def process_request(request):
+    """
+    Description:
+        Unpacks an e-mail, extracts the texts of its attachments, cleans the text and, if
+        models are loaded, classifies it. Runs in a worker process.
+    Parameters:
+        request (dic): Either {"path": path to eml-file} or {"eml": raw bytes}, and optionally "key" and "keys"
+    Returns:
+        response (dic): The dictionary output by unpack_attachments() with "clean_text" and "class" added
+    """
+    keys = request.get("keys", ["subject", "text", "html_text", "files_texts"])
+    if "eml" in request:
+        key = request.get("key", "request")
+        message = message_from_bytes(request["eml"])
+        unpack_dic = unpack_fun.unpack_message(message, None, key, None, in_memory=True)
+    else:
+        key = request.get("key") or unpack_fun.get_file_name(request["path"])[0]
+        unpack_dic = unpack_fun.unpack_eml(request["path"], key, worker_state["output_path"])
+    unpack_dic = extract_fun.unpack_attachments(unpack_dic, worker_state["cache"], *worker_state["timeouts"])
+    if "files" in unpack_dic:
+        unpack_dic["files"] = {file_name: value[:2] for file_name, value in unpack_dic["files"].items()}
+    filename, unpack_dic["clean_text"] = extract_fun.collect_and_clean_text(unpack_dic, keys)
+    if worker_state["models"]:
+        tokenizer, model, classes = worker_state["models"]
+        unpack_dic["class"] = str(worker_state["classification_fun"].predict_class(unpack_dic["clean_text"], tokenizer, model, classes))
+    return unpack_dic
+
+#####################
+### HTTP handling ###
+#####################
+
+async def read_http_request(reader, max_body_bytes):
+    """
+    Description:
+        Reads a HTTP/1.1 request with a Content-Length body
+    Parameters:
+        reader (asyncio.StreamReader): Stream of the connection
+        max_body_bytes (int): Largest body accepted
+    Returns:
+        method (str): E.g. "POST"
+        path (str): E.g. "/extract"
+        headers (dic): Headers with lower-case names
+        body (bytes): Body or None if it is larger than max_body_bytes
+    """
+    request_line = (await reader.readline()).decode("latin-1").strip()
+    method, path, version = request_line.split(" ", 2)
+    headers = {}
+    while True:
+        line = (await reader.readline()).decode("latin-1")
+        if line in ("\r\n", "\n", ""):
+            break
+        name, value = line.split(":", 1)
+        headers[name.strip().lower()] = value.strip()
+    length = int(headers.get("content-length", 0))
+    if length > max_body_bytes:
+        return method, path, headers, None
+    body = await reader.readexactly(length) if length else b""
+    return method, path, headers, body
+
+def create_http_response(status, body, content_type="application/json", extra_headers=None):
+    """
+    Description:
+        Creates a HTTP/1.1 response that closes the connection
+    Parameters:
+        status (int): Status code
+        body (bytes): Body
+        content_type (str): Content type of body
+        extra_headers (dic): Additional headers
+    Returns:
+        response (bytes): Response
+    """
+    headers = {"Content-Type": content_type, "Content-Length": str(len(body)), "Connection": "close"}
+    headers.update(extra_headers or {})
+    head = "HTTP/1.1 %d %s\r\n" % (status, HTTP_REASONS.get(status, "")) + "".join("%s: %s\r\n" % item for item in headers.items())
+    return head.encode("latin-1") + b"\r\n" + body
+
+def json_body(content):
+    return json.dumps(content, default=str).encode("utf-8")
+
+def format_service_metrics(service):
+    """
+    Description:
+        Formats the counters of the service in the Prometheus text format
+    Parameters:
+        service (dic): State created by create_service()
+    Returns:
+        metrics (str): Metrics
+    """
+    lines = []
+    for name in ["requests", "completed", "failed", "rejected", "restarts"]:
+        lines.append("# TYPE emltext_service_%s_total counter" % name)
+        lines.append("emltext_service_%s_total %d" % (name, service[name]))
+    lines.append("# TYPE emltext_service_seconds_total counter")
+    lines.append("emltext_service_seconds_total %r" % service["seconds"])
+    for name in ["queued", "in_flight"]:
+        lines.append("# TYPE emltext_service_%s gauge" % name)
+        lines.append("emltext_service_%s %d" % (name, service[name]))
+    return "\n".join(lines) + "\n"
+
+async def run_request(service, request):
+    """
+    Description:
+        Runs a request on the worker pool, waiting in the queue while the concurrency limit is reached
+    Parameters:
+        service (dic): State created by create_service()
+        request (dic): Request for process_request()
+    Returns:
+        status (int): HTTP status
+        response (dic): Response body
+    """
+    if service["queued"] >= service["max_queue"]:
+        service["rejected"] += 1
+        return 503, {"error": "Queue is full"}
+    service["queued"] += 1
+    try:
+        await service["semaphore"].acquire()
+    finally:
+        service["queued"] -= 1
+    service["in_flight"] += 1
+    start = time.perf_counter()
+    executor = service["executor"]
+    try:
+        loop = asyncio.get_running_loop()
+        response = await loop.run_in_executor(executor, process_request, request)
+        service["completed"] += 1
+        return 200, response
+    except BrokenProcessPool:
+        # A worker died, which breaks the whole pool until it is replaced
+        service["failed"] += 1
+        await replace_worker_pool(service, executor)
+        return 500, {"error": traceback.format_exc()}
+    except Exception:
+        service["failed"] += 1
+        return 500, {"error": traceback.format_exc()}
+    finally:
+        service["seconds"] += time.perf_counter() - start
+        service["in_flight"] -= 1
+        service["semaphore"].release()
+
+async def handle_connection(service, reader, writer):
+    """
+    Description:
+        Handles one HTTP request. POST /extract takes raw eml bytes, or JSON with "path" to an
+        eml-file, and returns the extraction result. GET /health and GET /metrics report on the service.
+    Parameters:
+        service (dic): State created by create_service()
+        reader (asyncio.StreamReader): Stream of the connection
+        writer (asyncio.StreamWriter): Stream of the connection
+    """
+    try:
+        method, path, headers, body = await read_http_request(reader, service["max_body_bytes"])
+        service["requests"] += 1
+        if path == "/health":
+            status = 200 if service["healthy"] else 503
+            content = {"status": "ok" if service["healthy"] else "restarting", "workers": service["workers"], "queued": service["queued"], "in_flight": service["in_flight"], "restarts": service["restarts"]}
+        elif path == "/metrics":
+            writer.write(create_http_response(200, format_service_metrics(service).encode("utf-8"), "text/plain; version=0.0.4"))
+            return
+        elif path != "/extract":
+            status, content = 404, {"error": "Unknown path"}
+        elif method != "POST":
+            status, content = 405, {"error": "Use POST"}
+        elif body is None:
+            status, content = 413, {"error": "Body is larger than %d bytes" % service["max_body_bytes"]}
+        elif headers.get("content-type", "").startswith("application/json"):
+            status, content = await run_request(service, json.loads(body))
+        else:
+            status, content = await run_request(service, {"eml": body, "key": headers.get("x-message-key", "request")})
+        extra_headers = {"Retry-After": "1"} if status == 503 else None
+        writer.write(create_http_response(status, json_body(content), extra_headers=extra_headers))
+    except Exception:
+        writer.write(create_http_response(400, json_body({"error": traceback.format_exc()})))
+    finally:
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+
+#########################
+### Service lifecycle ###
+#########################
+
+def create_worker_pool(workers, initargs):
+    """
+    Description:
+        Creates a pool of worker processes that are initialized by initialize_worker()
+    Parameters:
+        workers (int): Number of worker processes
+        initargs (tuple): Arguments of initialize_worker()
+    Returns:
+        executor (concurrent.futures.ProcessPoolExecutor): Worker pool
+    """
+    context = multiprocessing.get_context(WORKER_START_METHOD)
+    return ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=initialize_worker, initargs=initargs)
+
+def create_service(output_path, workers=None, max_concurrency=None, max_queue=100, max_body_bytes=100*1024**2, model_paths=None, cache_path=None, attachment_timeout=None, message_timeout=None):
+    """
+    Description:
+        Creates the worker pool and the state of the service
+    Parameters:
+        output_path (str): Output path for attachments of requests given by path
+        workers (int): Number of worker processes, defaults to the number of CPUs
+        max_concurrency (int): Maximum number of requests processed at once, defaults to workers
+        max_queue (int): Maximum number of requests waiting, further requests get 503
+        max_body_bytes (int): Largest request body accepted
+        model_paths (tuple): Optional path to a model bundle or paths to tokenizer, model and classes pickles
+        cache_path (str): Optional path to a text cache shared by the workers
+        attachment_timeout (float): Maximum seconds spent on a single attachment
+        message_timeout (float): Maximum seconds spent on all attachments of a message
+    Returns:
+        service (dic): State of the service
+    """
+    workers = workers or os.cpu_count() or 1
+    initargs = (output_path, model_paths, cache_path, attachment_timeout, message_timeout, workers)
+    executor = create_worker_pool(workers, initargs)
+    return {"executor": executor, "workers": workers, "initargs": initargs, "healthy": True, "semaphore": asyncio.Semaphore(max_concurrency or workers), "max_queue": max_queue, "max_body_bytes": max_body_bytes,
+            "requests": 0, "completed": 0, "failed": 0, "rejected": 0, "restarts": 0, "seconds": 0.0, "queued": 0, "in_flight": 0}
+
+async def warm_up_worker_pool(service):
+    """
+    Description:
+        Starts all worker processes of the pool, such that they are initialized before requests arrive
+    Parameters:
+        service (dic): State created by create_service()
+    """
+    loop = asyncio.get_running_loop()
+    await asyncio.gather(*[loop.run_in_executor(service["executor"], warm_up_worker) for i in range(service["workers"])])
+
+async def replace_worker_pool(service, broken_executor):
+    """
+    Description:
+        Replaces a broken worker pool with a new one with the same initializer. The service reports
+        itself unhealthy until the new workers are started. Requests that failed on the same broken
+        pool only replace it once.
+    Parameters:
+        service (dic): State created by create_service()
+        broken_executor (concurrent.futures.ProcessPoolExecutor): Pool that a request failed on
+    """
+    if service["executor"] is not broken_executor:
+        return
+    service["healthy"] = False
+    service["restarts"] += 1
+    print("WARN: A worker process died, restarting the worker pool")
+    broken_executor.shutdown(wait=False, cancel_futures=True)
+    service["executor"] = create_worker_pool(service["workers"], service["initargs"])
+    try:
+        await warm_up_worker_pool(service)
+        service["healthy"] = True
+    except BrokenProcessPool:
+        # The new workers failed to start, the next failing request tries again
+        print("WARN: The worker pool could not be restarted")
+
+async def start_service(service, host="127.0.0.1", port=8080, unix_socket=None):
+    """
+    Description:
+        Starts all worker processes and then listens for requests
+    Parameters:
+        service (dic): State created by create_service()
+        host (str): Host to listen on
+        port (int): Port to listen on
+        unix_socket (str): Path to a Unix socket to listen on instead of host and port
+    Returns:
+        server (asyncio.Server): Running server
+    """
+    await warm_up_worker_pool(service)
+    handler = lambda reader, writer: handle_connection(service, reader, writer)
+    if unix_socket:
+        return await asyncio.start_unix_server(handler, path=unix_socket)
+    return await asyncio.start_server(handler, host, port)
+
+async def serve(output_path, host="127.0.0.1", port=8080, unix_socket=None, **settings):
+    """
+    Description:
+        Runs the service until it is cancelled
+    Parameters:
+        output_path (str): Output path for attachments of requests given by path
+        host (str): Host to listen on
+        port (int): Port to listen on
+        unix_socket (str): Path to a Unix socket to listen on instead of host and port
+        settings (dic): Further arguments for create_service()
+    """
+    service = create_service(output_path, **settings)
+    try:
+        server = await start_service(service, host, port, unix_socket)
+        print("INFO: Service listening on " + (unix_socket or "%s:%d" % (host, port)))
+        async with server:
+            await server.serve_forever()
+    finally:
+        service["executor"].shutdown(cancel_futures=True)
+
+##############
+### Client ###
+##############
+
+async def request_service(method, path, body=b"", content_type="message/rfc822", host="127.0.0.1", port=8080, unix_socket=None):
+    """
+    Description:
+        Minimal client for the service, e.g. for local testing
+    Parameters:
+        method (str): "GET" or "POST"
+        path (str): "/extract", "/health" or "/metrics"
+        body (bytes): Raw eml-file or JSON
+        content_type (str): Content type of body
+        host (str): Host of service
+        port (int): Port of service
+        unix_socket (str): Path to Unix socket of service instead of host and port
+    Returns:
+        status (int): HTTP status
+        body (bytes): Response body
+    """
+    if unix_socket:
+        reader, writer = await asyncio.open_unix_connection(unix_socket)
+    else:
+        reader, writer = await asyncio.open_connection(host, port)
+    head = "%s %s HTTP/1.1\r\nHost: %s\r\nContent-Type: %s\r\nContent-Length: %d\r\nConnection: close\r\n\r\n" % (method, path, host, content_type, len(body))
+    writer.write(head.encode("latin-1") + body)
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    head, response_body = response.split(b"\r\n\r\n", 1)
+    return int(head.split(b" ", 2)[1]), response_body
+
+def call_service(eml_file=None, path="/extract", **connection):
+    """
+    Description:
+        Sends an eml-file to the service and returns the decoded result, or calls GET on path if no file is given
+    Parameters:
+        eml_file (str): Full path to eml-file, sent as raw bytes
+        path (str): Path on the service
+        connection (dic): host, port or unix_socket as for request_service()
+    Returns:
+        status (int): HTTP status
+        response (dic or str): Decoded JSON response, or text for /metrics
+    """
+    if eml_file:
+        with open(eml_file, "rb") as eml_file_io:
+            status, body = asyncio.run(request_service("POST", path, eml_file_io.read(), **connection))
+    else:
+        status, body = asyncio.run(request_service("GET", path, **connection))
+    if path == "/metrics":
+        return status, body.decode("utf-8")
+    return status, json.loads(body)
+
+##############################
+### Command-line interface ###
+##############################
+
+def main(argv=None):
+    """
+    Description:
+        Command-line entry point, e.g. python email_service_functions.py /tmp/attachments --port 8080 --workers 4
+    Parameters:
+        argv (list): Command-line arguments, defaults to sys.argv
+    """
+    parser = argparse.ArgumentParser(description="Runs the extraction as a service with a warm worker pool")
+    parser.add_argument("output_path", help="Output path for attachments of requests given by path")
+    parser.add_argument("--host", default="127.0.0.1", help="Host to listen on")
+    parser.add_argument("--port", type=int, default=8080, help="Port to listen on")
+    parser.add_argument("--unix-socket", default=None, help="Unix socket to listen on instead of host and port")
+    parser.add_argument("--workers", type=int, default=None, help="Number of worker processes")
+    parser.add_argument("--max-concurrency", type=int, default=None, help="Maximum number of requests processed at once")
+    parser.add_argument("--max-queue", type=int, default=100, help="Maximum number of waiting requests before 503 is returned")
+    parser.add_argument("--model", nargs="+", default=None, metavar="PATH", help="Model bundle, or tokenizer, model and classes pickles, used to classify texts")
+    parser.add_argument("--cache", default=None, help="Path to a SQLite cache of extracted texts")
+    parser.add_argument("--attachment-timeout", type=float, default=None, help="Maximum seconds spent on a single attachment")
+    parser.add_argument("--message-timeout", type=float, default=None, help="Maximum seconds spent on all attachments of a message")
+    args = parser.parse_args(argv)
+
+    unpack_fun.make_directory(args.output_path)
+    settings = {"workers": args.workers, "max_concurrency": args.max_concurrency, "max_queue": args.max_queue, "model_paths": args.model, "cache_path": args.cache,
+                "attachment_timeout": args.attachment_timeout, "message_timeout": args.message_timeout}
+    try:
+        asyncio.run(serve(args.output_path, args.host, args.port, args.unix_socket, **settings))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,269 @@
+import hashlib
+import os
+import re
+import sqlite3
+import tempfile
+import time
+import email_instrumentation_functions as instrument_fun
+
+########################
+### Attachment store ###
+########################
+
+def open_store(directory):
+    """
+    Description:
+        Opens (and creates if needed) a content-addressed attachment store. Every unique
+        attachment is stored once in a sharded directory layout, and a SQLite manifest
+        records which messages reference which blobs. The store can be shared by several processes.
+    Parameters:
+        directory (str): Root directory of the store
+    Returns:
+        store (dic): Directory and connection to the manifest of the store
+    """
+    os.makedirs(directory, exist_ok=True)
+    manifest = sqlite3.connect(os.path.join(directory, "manifest.sqlite"), timeout=60, isolation_level=None)
+    manifest.execute("PRAGMA journal_mode=WAL")
+    manifest.execute("CREATE TABLE IF NOT EXISTS blobs (blob TEXT PRIMARY KEY, size INTEGER NOT NULL, refcount INTEGER NOT NULL, created REAL NOT NULL)")
+    manifest.execute("CREATE INDEX IF NOT EXISTS blobs_refcount ON blobs (refcount)")
+    manifest.execute("CREATE TABLE IF NOT EXISTS refs (key TEXT NOT NULL, file_name TEXT NOT NULL, blob TEXT NOT NULL, PRIMARY KEY (key, file_name, blob))")
+    upgrade_refs(manifest)
+    return {"directory": directory, "manifest": manifest}
+
+def upgrade_refs(manifest):
+    """
+    Description:
+        Adds the blob to the primary key of references in stores created before it was part of it,
+        where a message could only reference one blob per file name
+    Parameters:
+        manifest (sqlite3.Connection): Manifest of a store
+    """
+    primary_key = [row[1] for row in manifest.execute("PRAGMA table_info(refs)").fetchall() if row[5]]
+    if "blob" in primary_key:
+        return
+    manifest.execute("BEGIN IMMEDIATE")
+    try:
+        manifest.execute("CREATE TABLE refs_upgrade (key TEXT NOT NULL, file_name TEXT NOT NULL, blob TEXT NOT NULL, PRIMARY KEY (key, file_name, blob))")
+        manifest.execute("INSERT INTO refs_upgrade SELECT key, file_name, blob FROM refs")
+        manifest.execute("DROP TABLE refs")
+        manifest.execute("ALTER TABLE refs_upgrade RENAME TO refs")
+        manifest.execute("COMMIT")
+    except:
+        manifest.execute("ROLLBACK")
+        raise
+
+def close_store(store):
+    """
+    Description:
+        Closes the manifest of a store opened with open_store()
+    Parameters:
+        store (dic): Store opened with open_store()
+    """
+    store["manifest"].close()
+
+def create_blob_name(digest, file_name):
+    """
+    Description:
+        Creates the name of a blob from its hash and the extension of the attachment. The
+        extension is kept, because the text extraction chooses its method by extension.
+    Parameters:
+        digest (str): Hex digest of the content
+        file_name (str): File name of the attachment
+    Returns:
+        blob (str): E.g. 3a7bd3e2360a3d...pdf
+    """
+    extension = re.sub(r'[^\w.]', '', os.path.splitext(file_name)[1].lower())
+    return digest + extension
+
+def get_blob_path(store, blob):
+    """
+    Description:
+        Returns the path of a blob, sharded by the first four characters of its hash
+    Parameters:
+        store (dic): Store opened with open_store()
+        blob (str): Name created by create_blob_name()
+    Returns:
+        path (str): Full path to blob
+    """
+    return os.path.join(store["directory"], blob[:2], blob[2:4], blob)
+
+def store_blob(store, payload, key, file_name, digest=None):
+    """
+    Description:
+        Stores an attachment unless an identical one is already stored, and records that
+        the message references it. Storing the same attachment of the same message again
+        does not change the reference count, while attachments of a message that share a
+        name but differ in content are each referenced.
+    Parameters:
+        store (dic): Store opened with open_store()
+        payload (bytes): Decoded attachment
+        key (str): ID string for the message
+        file_name (str): Decoded filename of attachment
+        digest (str): SHA-256 hex digest of payload if it was computed while decoding
+    Returns:
+        path (str): Full path to blob
+        digest (str): SHA-256 hex digest of payload
+    """
+    payload = payload or b""
+    digest = digest or hashlib.sha256(payload).hexdigest()
+    blob = create_blob_name(digest, file_name)
+    blob_path = get_blob_path(store, blob)
+    manifest = store["manifest"]
+
+    # New blobs are written to a temporary file first, such that the manifest is only locked for a rename
+    temp_path = None
+    if manifest.execute("SELECT 1 FROM blobs WHERE blob = ?", (blob,)).fetchone() is None:
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+        file_descriptor, temp_path = tempfile.mkstemp(dir=os.path.dirname(blob_path), suffix=".tmp")
+        with os.fdopen(file_descriptor, "wb") as file_io:
+            file_io.write(payload)
+    try:
+        manifest.execute("BEGIN IMMEDIATE")
+        try:
+            manifest.execute("INSERT OR IGNORE INTO blobs VALUES (?, ?, 0, ?)", (blob, len(payload), time.time()))
+            if manifest.execute("INSERT OR IGNORE INTO refs VALUES (?, ?, ?)", (key, file_name, blob)).rowcount:
+                manifest.execute("UPDATE blobs SET refcount = refcount + 1 WHERE blob = ?", (blob,))
+            if not os.path.exists(blob_path):
+                if temp_path is None:
+                    # The manifest knew the blob, but its file is missing
+                    os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+                    with open(blob_path, "wb") as file_io:
+                        file_io.write(payload)
+                else:
+                    os.replace(temp_path, blob_path)
+                    temp_path = None
+                instrument_fun.increment("blobs_stored")
+            else:
+                instrument_fun.increment("blobs_deduplicated")
+                instrument_fun.increment("bytes_deduplicated", len(payload))
+            manifest.execute("COMMIT")
+        except:
+            manifest.execute("ROLLBACK")
+            raise
+    finally:
+        if temp_path is not None:
+            os.remove(temp_path)
+    return blob_path, digest
+
+def store_file(store, temp_path, key, file_name, digest):
+    """
+    Description:
+        Stores an attachment that was already decoded to a temporary file, e.g. by
+        LazyPart.write_payload() in email_index_functions, unless an identical one is already stored.
+        The temporary file is renamed into place or removed, so it must be in the store directory.
+    Parameters:
+        store (dic): Store opened with open_store()
+        temp_path (str): Full path to the temporary file, which is consumed
+        key (str): ID string for the message
+        file_name (str): Decoded filename of attachment
+        digest (str): SHA-256 hex digest of the file, computed while it was written
+    Returns:
+        path (str): Full path to blob
+        digest (str): SHA-256 hex digest of the file
+    """
+    blob = create_blob_name(digest, file_name)
+    blob_path = get_blob_path(store, blob)
+    manifest = store["manifest"]
+    size = os.path.getsize(temp_path)
+    try:
+        manifest.execute("BEGIN IMMEDIATE")
+        try:
+            manifest.execute("INSERT OR IGNORE INTO blobs VALUES (?, ?, 0, ?)", (blob, size, time.time()))
+            if manifest.execute("INSERT OR IGNORE INTO refs VALUES (?, ?, ?)", (key, file_name, blob)).rowcount:
+                manifest.execute("UPDATE blobs SET refcount = refcount + 1 WHERE blob = ?", (blob,))
+            if not os.path.exists(blob_path):
+                os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+                os.replace(temp_path, blob_path)
+                instrument_fun.increment("blobs_stored")
+            else:
+                instrument_fun.increment("blobs_deduplicated")
+                instrument_fun.increment("bytes_deduplicated", size)
+            manifest.execute("COMMIT")
+        except:
+            manifest.execute("ROLLBACK")
+            raise
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    return blob_path, digest
+
+##########################
+### Reference counting ###
+##########################
+
+def create_message_key(eml_file):
+    """
+    Description:
+        Creates the key under which a message references blobs. The hash of the full path keeps
+        equally named files in different folders apart, such that releasing one does not release the other.
+    Parameters:
+        eml_file (str): Full path to eml-file
+    Returns:
+        key (str): File name and hash of the full path
+    """
+    filename = os.path.splitext(os.path.basename(eml_file))[0]
+    return filename + "." + hashlib.sha1(os.path.abspath(eml_file).encode("utf-8")).hexdigest()[:12]
+
+def release_message(store, key):
+    """
+    Description:
+        Removes the references of a message, e.g. when it is deleted or reprocessed.
+        Blobs that are no longer referenced are removed by collect_garbage().
+    Parameters:
+        store (dic): Store opened with open_store()
+        key (str): ID string for the message
+    Returns:
+        released (int): Number of references removed
+    """
+    manifest = store["manifest"]
+    manifest.execute("BEGIN IMMEDIATE")
+    try:
+        blobs = manifest.execute("SELECT blob, COUNT(*) FROM refs WHERE key = ? GROUP BY blob", (key,)).fetchall()
+        manifest.executemany("UPDATE blobs SET refcount = refcount - ? WHERE blob = ?", [(count, blob) for blob, count in blobs])
+        manifest.execute("DELETE FROM refs WHERE key = ?", (key,))
+        manifest.execute("COMMIT")
+    except:
+        manifest.execute("ROLLBACK")
+        raise
+    return sum(count for blob, count in blobs)
+
+def collect_garbage(store):
+    """
+    Description:
+        Deletes blobs that no message references. The manifest stays locked while files are
+        deleted, such that no other process can reference a blob that is being removed.
+    Parameters:
+        store (dic): Store opened with open_store()
+    Returns:
+        removed (dic): Number of blobs and bytes removed
+    """
+    manifest = store["manifest"]
+    manifest.execute("BEGIN IMMEDIATE")
+    try:
+        rows = manifest.execute("SELECT blob, size FROM blobs WHERE refcount <= 0").fetchall()
+        for blob, size in rows:
+            try:
+                os.remove(get_blob_path(store, blob))
+            except FileNotFoundError:
+                pass
+        manifest.executemany("DELETE FROM blobs WHERE blob = ?", [(blob,) for blob, size in rows])
+        manifest.execute("COMMIT")
+    except:
+        manifest.execute("ROLLBACK")
+        raise
+    return {"blobs": len(rows), "bytes": sum(size for blob, size in rows)}
+
+def store_statistics(store):
+    """
+    Description:
+        Returns the size of the store compared to the size of all referenced attachments
+    Parameters:
+        store (dic): Store opened with open_store()
+    Returns:
+        statistics (dic): Blobs, references, stored bytes, referenced bytes and the deduplication ratio
+    """
+    manifest = store["manifest"]
+    blobs, stored_bytes = manifest.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM blobs").fetchone()
+    references, referenced_bytes = manifest.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM refs JOIN blobs USING (blob)").fetchone()
+    ratio = referenced_bytes / stored_bytes if stored_bytes else None
+    return {"blobs": blobs, "references": references, "stored_bytes": stored_bytes, "referenced_bytes": referenced_bytes, "deduplication_ratio": ratio}
@@ -2,9 +2,11 @@ import glob
 import os
 import uuid
 import shutil
+import tempfile
 import re
 import string
-from bs4 import BeautifulSoup
+import email_instrumentation_functions as instrument_fun
+import email_store_functions as store_fun
 from email import message_from_file, message_from_bytes
 from email.header import Header, decode_header, make_header
 from email.utils import parseaddr
@@ -174,7 +176,7 @@ def decode_text_and_html_payload(message):
         chars (str): Decoded string
     """
     bytes = message.get_payload(decode=True)
-    charset = message.get_content_charset()
+    charset = message.get_content_charset() or "iso-8859-1"
     chars = bytes.decode(charset, 'replace')
     return chars
 
@@ -235,7 +237,89 @@ def get_email_address(string):
     
     return address
 
-def extract_text_from_html_message(html_message, remove_comment=True, remove_hex=True):
+# Tags whose strings BeautifulSoup leaves out of get_text(), and tags where it keeps whitespace as is
+HTML_SKIPPED_TAGS = frozenset(["script", "style", "template", "rt", "rp"])
+HTML_PRESERVE_WHITESPACE_TAGS = frozenset(["pre", "textarea"])
+HTML_ASCII_SPACES = frozenset("\x20\x0a\x09\x0c\x0d")
+
+class HtmlTextTarget:
+    """
+    Description:
+        Parser target for lxml that collects the strings of an HTML document the way
+        BeautifulSoup does, without building a tree. Consecutive text is one string,
+        strings consisting only of ASCII whitespace become a single space or newline
+        (except inside pre/textarea), and strings inside skipped tags and comments are left out.
+    Parameters:
+        skipped_tags (set): Tags whose strings are left out
+    """
+    def __init__(self, skipped_tags=HTML_SKIPPED_TAGS):
+        self.skipped_tags = skipped_tags
+        self.strings = []
+        self.current_data = []
+        self.skipped_stack = []
+        self.preserve_stack = []
+
+    def end_data(self):
+        if not self.current_data:
+            return
+        string = "".join(self.current_data)
+        self.current_data = []
+        if not self.preserve_stack and HTML_ASCII_SPACES.issuperset(string):
+            string = "\n" if "\n" in string else " "
+        if not self.skipped_stack:
+            self.strings.append(string)
+
+    def start(self, tag, attrib):
+        self.end_data()
+        if tag in self.skipped_tags:
+            self.skipped_stack.append(tag)
+        if tag in HTML_PRESERVE_WHITESPACE_TAGS:
+            self.preserve_stack.append(tag)
+
+    def end(self, tag):
+        self.end_data()
+        if self.skipped_stack and self.skipped_stack[-1] == tag:
+            self.skipped_stack.pop()
+        if self.preserve_stack and self.preserve_stack[-1] == tag:
+            self.preserve_stack.pop()
+
+    def data(self, content):
+        self.current_data.append(content)
+
+    def comment(self, text):
+        self.end_data()
+
+    def pi(self, target, data=None):
+        self.end_data()
+
+    def doctype(self, name, pubid, system):
+        self.end_data()
+
+    def close(self):
+        self.end_data()
+        return self.strings
+
+def html_to_text(html, separator=' ', skipped_tags=HTML_SKIPPED_TAGS):
+    """ 
+    Description:
+        Extracts text from HTML with lxml's parser events instead of a BeautifulSoup tree.
+        The result is the same as BeautifulSoup(html, features="lxml").get_text(separator).
+    Parameters:
+        html (str): HTML
+        separator (str): String put between the strings of the document
+        skipped_tags (set): Tags whose strings are left out, by default script, style and template
+    Returns:
+        text (str): Text with no HTML
+    """
+    if not html:
+        return ""
+    from lxml import etree
+    parser = etree.HTMLParser(target=HtmlTextTarget(skipped_tags), recover=True, strip_cdata=False)
+    parser.feed(html)
+    return separator.join(parser.close())
+
+@instrument_fun.timed("extract_text_from_html_message")
+def extract_text_from_html_message(html_message, remove_comment=True, remove_hex=True, engine="bs4"):
     """ 
     Description:
         This function extracts text from an email message with the content type 'text/html'
@@ -243,12 +327,17 @@ def extract_text_from_html_message(html_message, remove_comment=True, remove_hex
         html_message (email.message.Message): A email message with the content type 'text/html'
         encoding (str): Encoding used for decoding the message
         remove_comment (bool): Whether to remove the html text between <!-- and -->
+        engine (str): "bs4" to parse with BeautifulSoup or "lxml" to use the faster html_to_text()
     Returns:
         text (str): Text with no HTML
     """
     myhtml = decode_text_and_html_payload(html_message)
-    soup = BeautifulSoup(myhtml, features="lxml")
-    text = soup.get_text(separator=' ')
+    if engine == "lxml":
+        text = html_to_text(myhtml)
+    else:
+        from bs4 import BeautifulSoup
+        soup = BeautifulSoup(myhtml, features="lxml")
+        text = soup.get_text(separator=' ')
     
     if remove_comment:
         text = re.sub('<!--[^>]+-->', '', text)
@@ -257,7 +346,42 @@ def extract_text_from_html_message(html_message, remove_comment=True, remove_hex
     
     return text
 
-def extract_content(message, key, output_path):
+def store_attachment(payload, key, file_name, id, output_path, in_memory=False, spill_threshold=10*1024**2, store=None):
+    """
+    Description:
+        Stores the payload of an attachment either as a file in the output path or, in
+        in-memory mode, as bytes. In in-memory mode payloads larger than the spill
+        threshold are written to a temporary file instead of being kept in memory.
+    Parameters:
+        payload (bytes): Decoded attachment
+        key (str): ID string for the message
+        file_name (str): Decoded filename of attachment
+        id (str): Content-ID of attachment or None
+        output_path (str): Output path
+        in_memory (bool): Whether to keep the payload in memory instead of writing it to the output path
+        spill_threshold (int): Payloads larger than this number of bytes are spilled to a temporary file
+        store (dic): Optional content-addressed store opened with email_store_functions.open_store(),
+            in which case identical attachments share one file instead of being written to the output path
+    Returns:
+        file (tuple): (path, content-ID) or in in-memory mode (name, content-ID, bytes or path to temporary file)
+    """
+    instrument_fun.increment("bytes_decoded", len(payload or b""))
+    if store is not None and not in_memory:
+        blob_path, digest = store_fun.store_blob(store, payload, key, file_name)
+        return (blob_path, id)
+    attachment_file_name = create_name(key, file_name)
+    if not in_memory:
+        if not file_exists(output_path, attachment_file_name):
+            save_file(output_path, attachment_file_name, payload)
+        return (output_path + "/" + attachment_file_name, id)
+    if payload is not None and len(payload) > spill_threshold:
+        file_descriptor, spill_path = tempfile.mkstemp(suffix="." + attachment_file_name)
+        with os.fdopen(file_descriptor, "wb") as file_io:
+            file_io.write(payload)
+        return (attachment_file_name, id, spill_path)
+    return (attachment_file_name, id, payload)
+
+def extract_content(message, key, output_path, in_memory=False, spill_threshold=10*1024**2, html_engine="bs4", store=None):
     """
     Description:
         Extracts content from an e-mail message including multipart and nested multipart messages.
@@ -265,6 +389,10 @@ def extract_content(message, key, output_path):
         message (email.message.Message): A email message object created using the email module
         key (str): ID string for the message
         output_path (str): Output path
+        in_memory (bool): Whether to keep attachments in memory instead of writing them to the output path
+        spill_threshold (int): In in-memory mode, attachments larger than this number of bytes are spilled to a temporary file
+        html_engine (str): Engine used by extract_text_from_html_message(), "bs4" or "lxml"
+        store (dic): Optional content-addressed attachment store opened with email_store_functions.open_store()
     Returns:
         Text (str): All texts from all parts
         Html (str): All HTMLs from all parts
@@ -289,11 +417,7 @@ def extract_content(message, key, output_path):
         # Handling Attachments
         if message.get_filename(): 
             file_name = decode_filename(message.get_filename())
-            attachment_file_name = create_name(key, file_name)
-            Files[file_name] = (output_path + "/" + attachment_file_name, None)
-            if file_exists(output_path, attachment_file_name): 
-                return Text, Html, Html_text, Files, 1
-            save_file(output_path, attachment_file_name, message.get_payload(decode=True))
+            Files[file_name] = store_attachment(message.get_payload(decode=True), key, file_name, None, output_path, in_memory, spill_threshold, store)
             return Text, Html, Html_text, Files, 1
         
         # Handling other content types
@@ -302,10 +426,10 @@ def extract_content(message, key, output_path):
             Text += decode_text_and_html_payload(message)
         elif content_type=="text/html":
             Html += decode_text_and_html_payload(message)
-            Html_text += extract_text_from_html_message(message)
+            Html_text += extract_text_from_html_message(message, engine=html_engine)
         else:
             # Handling content types other than text and html
-            content_type_header = message.get("content-type")
+            content_type_header = message.get("content-type", "")
             try: 
                 id = remove_square_brackets(message.get("content-id"))
             except: 
@@ -314,17 +438,13 @@ def extract_content(message, key, output_path):
             # Finding filename in content header
             o = content_type_header.find("name=")
             if o==-1: 
-                return Text, Html, Files, 1
+                return Text, Html, Html_text, Files, 1
             ox = content_type_header.find(";", o)
-            if name2==-1: 
-                name2 = None
-            o += 5; file_name = cp[o:ox]
+            if ox==-1: 
+                ox = None
+            o += 5; file_name = content_type_header[o:ox]
             file_name = remove_quotes(file_name)
-            output_file_name = create_name(key, file_name)
-            Files[file_name] = (output_path + "/" + output_file_name, id)
-            if file_exists(output_file_name): 
-                return Text, Html, Files, 1
-            save_file(output_path, output_file_name, m.get_payload(decode=True))
+            Files[file_name] = store_attachment(message.get_payload(decode=True), key, file_name, id, output_path, in_memory, spill_threshold, store)
         return Text, Html, Html_text, Files, 1
     
     # Extracting data recursively for multipart messages
@@ -337,7 +457,7 @@ def extract_content(message, key, output_path):
             break
             
         # The payload (Message object) goes back into the function
-        text, html, html_text, files, parts = extract_content(payload, key, output_path)
+        text, html, html_text, files, parts = extract_content(payload, key, output_path, in_memory, spill_threshold, html_engine, store)
         Text += text
         Html += html
         Html_text += html_text
@@ -350,24 +470,54 @@ def extract_content(message, key, output_path):
 ### Main wrapper function ###
 #############################
 
-def unpack_eml(eml_file, key, output_path):
+def unpack_message(message, input_file, key, output_path, in_memory=False, spill_threshold=10*1024**2, html_engine="bs4", store=None):
     """
     Description:
-        Extracts data from e-mail and returns it as a dictionary
+        Extracts data from a parsed e-mail and returns it as a dictionary
     Parameters:
-        eml_file (_io.BufferedReader): An open eml-file
+        message (email.message.Message): A email message object created using the email module
+        input_file (str): Identifies where the message was read from
         key (str): ID string for the message
-        output_path (str): Output path
+        output_path (str): Output path, not used in in-memory mode
+        in_memory (bool): Whether to keep attachments in memory instead of writing them to the output path
+        spill_threshold (int): In in-memory mode, attachments larger than this number of bytes are spilled to a temporary file
+        html_engine (str): Engine used to extract text from HTML, "bs4" or "lxml"
+        store (dic): Optional content-addressed attachment store opened with email_store_functions.open_store()
     Returns:
         msg (dic): A dictionary with file text and attachments is returned
     """
-    eml_file_io = open_file(eml_file)
-    message = message_from_file(eml_file_io)
     From, To, Subject, Date = get_header_data(message)
-    Text, Html, Html_text, Files, Parts = extract_content(message, key, output_path)
+    with instrument_fun.span("extract_content"):
+        Text, Html, Html_text, Files, Parts = extract_content(message, key, output_path, in_memory, spill_threshold, html_engine, store)
     Text = Text.strip()
     Html = Html.strip()
-    unpacked_eml = {"input_file": eml_file, "subject": Subject, "from": From, "to": To, "date": Date, "text": Text, "html": Html, "html_text": Html_text, "parts": Parts}
+    unpacked_eml = {"input_file": input_file, "subject": Subject, "from": From, "to": To, "date": Date, "text": Text, "html": Html, "html_text": Html_text, "parts": Parts}
     if Files: 
         unpacked_eml["files"] = Files
-    return unpacked_eml
\ No newline at end of file
+    return unpacked_eml
+
+@instrument_fun.timed("unpack_eml")
+def unpack_eml(eml_file, key, output_path, in_memory=False, spill_threshold=10*1024**2, html_engine="bs4", store=None, streaming=False):
+    """
+    Description:
+        Extracts data from e-mail and returns it as a dictionary
+    Parameters:
+        eml_file (_io.BufferedReader): An open eml-file
+        key (str): ID string for the message
+        output_path (str): Output path, not used in in-memory mode
+        in_memory (bool): Whether to keep attachments in memory instead of writing them to the output path
+        spill_threshold (int): In in-memory mode, attachments larger than this number of bytes are spilled to a temporary file
+        html_engine (str): Engine used to extract text from HTML, "bs4" or "lxml"
+        store (dic): Optional content-addressed attachment store opened with email_store_functions.open_store()
+        streaming (bool): Whether to memory-map the file and decode attachments in chunks, such that
+            memory use does not grow with the size of attachments, see email_index_functions.unpack_lazy_eml()
+    Returns:
+        msg (dic): A dictionary with file text and attachments is returned
+    """
+    if streaming:
+        import email_index_functions as index_fun
+        return index_fun.unpack_lazy_eml(eml_file, key, output_path, in_memory, spill_threshold, html_engine, store)
+    eml_file_io = open_file(eml_file)
+    message = message_from_file(eml_file_io)
+    eml_file_io.close()
+    return unpack_message(message, eml_file, key, output_path, in_memory, spill_threshold, html_engine, store)
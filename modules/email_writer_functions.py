@@ -0,0 +1,257 @@
+import gzip
+import importlib.util
+import json
+import os
+import re
+
+# Parquet needs the optional pyarrow package, which is imported when a Parquet writer is opened
+PYARROW_AVAILABLE = importlib.util.find_spec("pyarrow") is not None
+
+# Columns of every result in a stable order. Fields missing from a result are written as null.
+RESULT_FIELDS = ["input_file", "subject", "from", "to", "date", "text", "html", "html_text", "parts", "files", "files_texts", "files_pages", "timed_out", "truncated_files", "clean_text", "truncated_text", "class"]
+INTEGER_FIELDS = ["parts"]
+BOOLEAN_FIELDS = ["truncated_text"]
+MAPPING_FIELDS = ["files", "files_texts", "files_pages", "truncated_files"]
+LIST_FIELDS = ["timed_out"]
+
+# Fields of the report of a truncated or skipped attachment under "truncated_files"
+TRUNCATION_FIELDS = ["pages", "pages_extracted", "truncated", "skipped"]
+HEAVY_FIELDS = ["html", "html_text", "text", "files_texts"]
+
+##############
+### Schema ###
+##############
+
+def create_result_row(unpack_dic, fields=RESULT_FIELDS):
+    """
+    Description:
+        Converts a dictionary output by unpack_eml(), unpack_attachments() or collect_and_clean_text()
+        into a row with exactly the given fields. Files are mapped to their path, such that the
+        payloads of in-memory attachments are never written.
+    Parameters:
+        unpack_dic (dic): Dictionary output by the pipeline
+        fields (list): Fields of the row
+    Returns:
+        row (dic): Row with the fields in order
+    """
+    row = {}
+    for field in fields:
+        value = unpack_dic.get(field)
+        if field == "files" and value is not None:
+            value = {file_name: str(file[0]) for file_name, file in value.items()}
+        elif field == "files_texts" and value is not None:
+            value = {str(file_name): str(text) for file_name, text in value.items()}
+        elif field == "files_pages" and value is not None:
+            value = {str(file_name): [str(decision) for decision in decisions] for file_name, decisions in value.items()}
+        elif field == "truncated_files" and value is not None:
+            value = {str(file_name): {name: report.get(name) for name in TRUNCATION_FIELDS} for file_name, report in value.items()}
+        elif field == "timed_out" and value is not None:
+            value = [str(file_name) for file_name in value]
+        elif field == "parts" and value is not None:
+            value = int(value)
+        elif field in BOOLEAN_FIELDS and value is not None:
+            value = bool(value)
+        elif field not in INTEGER_FIELDS + BOOLEAN_FIELDS + MAPPING_FIELDS + LIST_FIELDS and value is not None:
+            value = str(value)
+        row[field] = value
+    return row
+
+def create_arrow_schema(fields=RESULT_FIELDS):
+    """
+    Description:
+        Creates the Arrow schema of the Parquet shards
+    Parameters:
+        fields (list): Fields of the rows
+    Returns:
+        schema (pyarrow.Schema): Schema with strings, an integer for parts, a boolean for truncated_text, maps
+            from file name to path, text, page decisions and truncation report, and a list for timed_out
+    """
+    import pyarrow as pa
+    mapping_types = {"files_pages": pa.list_(pa.string()),
+                     "truncated_files": pa.struct([("pages", pa.int64()), ("pages_extracted", pa.int64()), ("truncated", pa.bool_()), ("skipped", pa.bool_())])}
+    types = []
+    for field in fields:
+        if field in INTEGER_FIELDS:
+            types.append((field, pa.int64()))
+        elif field in BOOLEAN_FIELDS:
+            types.append((field, pa.bool_()))
+        elif field in MAPPING_FIELDS:
+            types.append((field, pa.map_(pa.string(), mapping_types.get(field, pa.string()))))
+        elif field in LIST_FIELDS:
+            types.append((field, pa.list_(pa.string())))
+        else:
+            types.append((field, pa.string()))
+    return pa.schema(types)
+
+##############
+### Writer ###
+##############
+
+def open_writer(directory, output_format="jsonl", drop_fields=(), shard_rows=100000, buffer_rows=1000, buffer_bytes=64*1024**2, prefix="results"):
+    """
+    Description:
+        Opens a streaming writer that appends results to sharded JSONL (gzip) or Parquet files.
+        At most buffer_rows results or buffer_bytes of text are kept in memory before they are
+        written, and a new shard is started every shard_rows results. Shards are written under a
+        temporary name and renamed when complete, so readers never see a partial shard. Shards are
+        numbered after the shards already in the directory, such that a second run adds shards
+        instead of overwriting those of the first.
+    Parameters:
+        directory (str): Output directory
+        output_format (str): "jsonl" or "parquet", the latter requires pyarrow
+        drop_fields (list): Fields that are not written, e.g. HEAVY_FIELDS or ["html"]
+        shard_rows (int): Number of results per shard
+        buffer_rows (int): Maximum number of buffered results, which is also the Parquet row group size
+        buffer_bytes (int): Maximum number of buffered characters of text
+        prefix (str): Prefix of shard names
+    Returns:
+        writer (dic): State of the writer
+    """
+    if output_format not in ("jsonl", "parquet"):
+        raise ValueError("Unknown output format: " + output_format)
+    if output_format == "parquet" and not PYARROW_AVAILABLE:
+        raise ImportError("pyarrow is required to write Parquet")
+    os.makedirs(directory, exist_ok=True)
+    fields = [field for field in RESULT_FIELDS if field not in drop_fields]
+    extension = ".jsonl.gz" if output_format == "jsonl" else ".parquet"
+    writer = {"directory": directory, "format": output_format, "fields": fields, "prefix": prefix, "extension": extension,
+              "shard_rows": shard_rows, "buffer_rows": buffer_rows, "buffer_bytes": buffer_bytes,
+              "buffer": [], "buffered_bytes": 0, "shard": None, "shard_number": next_shard_number(directory, prefix, extension),
+              "shard_count": 0, "shards": [], "rows": 0}
+    if output_format == "parquet":
+        writer["schema"] = create_arrow_schema(fields)
+    return writer
+
+def next_shard_number(directory, prefix, extension):
+    """
+    Description:
+        Finds the number following the highest numbered shard in a directory, counting unfinished
+        temporary shards as well
+    Parameters:
+        directory (str): Output directory
+        prefix (str): Prefix of shard names
+        extension (str): Extension of shard names
+    Returns:
+        shard_number (int): Number of the next shard
+    """
+    pattern = re.compile(re.escape(prefix) + r"-(\d+)" + re.escape(extension) + r"(\.tmp)?$")
+    numbers = [int(match.group(1)) for match in map(pattern.match, os.listdir(directory)) if match]
+    return max(numbers) + 1 if numbers else 0
+
+def estimate_row_bytes(row):
+    """
+    Description:
+        Estimates the size of a row from the length of its texts
+    Parameters:
+        row (dic): Row created by create_result_row()
+    Returns:
+        size (int): Number of characters
+    """
+    size = 0
+    for value in row.values():
+        if isinstance(value, str):
+            size += len(value)
+        elif isinstance(value, dict):
+            size += sum(len(key) + len(text) for key, text in value.items())
+    return size
+
+def open_shard(writer):
+    """
+    Description:
+        Starts the next shard
+    Parameters:
+        writer (dic): Writer opened with open_writer()
+    """
+    path = os.path.join(writer["directory"], "%s-%05d%s" % (writer["prefix"], writer["shard_number"], writer["extension"]))
+    temp_path = path + ".tmp"
+    if writer["format"] == "jsonl":
+        shard_io = gzip.open(temp_path, "wt", encoding="utf-8")
+    else:
+        import pyarrow.parquet as pq
+        shard_io = pq.ParquetWriter(temp_path, writer["schema"], compression="zstd")
+    writer["shard"] = {"path": path, "temp_path": temp_path, "io": shard_io}
+    writer["shard_number"] += 1
+    writer["shard_count"] = 0
+
+def close_shard(writer):
+    """
+    Description:
+        Finishes the current shard and gives it its final name
+    Parameters:
+        writer (dic): Writer opened with open_writer()
+    """
+    shard = writer["shard"]
+    if shard is None:
+        return
+    shard["io"].close()
+    os.replace(shard["temp_path"], shard["path"])
+    writer["shards"].append(shard["path"])
+    writer["shard"] = None
+
+def flush_writer(writer):
+    """
+    Description:
+        Writes the buffered results to the current shard, as one Parquet row group or as JSON lines
+    Parameters:
+        writer (dic): Writer opened with open_writer()
+    """
+    rows = writer["buffer"]
+    while rows:
+        if writer["shard"] is None:
+            open_shard(writer)
+        count = min(len(rows), writer["shard_rows"] - writer["shard_count"])
+        batch, rows = rows[:count], rows[count:]
+        if writer["format"] == "jsonl":
+            writer["shard"]["io"].writelines(json.dumps(row, ensure_ascii=False) + "\n" for row in batch)
+        else:
+            import pyarrow as pa
+            columns = {field: [row[field] for row in batch] for field in writer["fields"]}
+            columns.update({field: [list(value.items()) if value is not None else None for value in columns[field]] for field in MAPPING_FIELDS if field in columns})
+            writer["shard"]["io"].write_table(pa.Table.from_pydict(columns, schema=writer["schema"]))
+        writer["shard_count"] += count
+        if writer["shard_count"] >= writer["shard_rows"]:
+            close_shard(writer)
+    writer["buffer"] = []
+    writer["buffered_bytes"] = 0
+
+def append_result(writer, unpack_dic):
+    """
+    Description:
+        Adds a result to the writer, writing the buffer when it is full
+    Parameters:
+        writer (dic): Writer opened with open_writer()
+        unpack_dic (dic): Dictionary output by the pipeline
+    """
+    row = create_result_row(unpack_dic, writer["fields"])
+    writer["buffer"].append(row)
+    writer["buffered_bytes"] += estimate_row_bytes(row)
+    writer["rows"] += 1
+    if len(writer["buffer"]) >= writer["buffer_rows"] or writer["buffered_bytes"] >= writer["buffer_bytes"]:
+        flush_writer(writer)
+
+def close_writer(writer):
+    """
+    Description:
+        Writes the remaining results and finishes the last shard
+    Parameters:
+        writer (dic): Writer opened with open_writer()
+    Returns:
+        shards (list): Paths to all shards written
+    """
+    flush_writer(writer)
+    close_shard(writer)
+    return writer["shards"]
+
+def read_jsonl_shards(paths):
+    """
+    Description:
+        Reads results from JSONL shards one at a time
+    Parameters:
+        paths (list): Paths to shards
+    Returns:
+        row (dic): Result
+    """
+    for path in paths:
+        with gzip.open(path, "rt", encoding="utf-8") as shard_io:
+            for line in shard_io:
+                yield json.loads(line)